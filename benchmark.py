@@ -0,0 +1,292 @@
+import argparse
+import collections
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import PIL
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+import postergen
+
+# Each scenario is a synthetic poster: its size, how many lines of text, how many
+# !font switches, which kinds of image it includes, whether it has a background and
+# whether banded rendering is checked against the full render
+SCENARIOS = {
+    'text': dict(size=(1024, 1536), lines=20, fonts=1, images=(), background=False, bands=True),
+    'text-many': dict(size=(1024, 1536), lines=200, fonts=4, images=(), background=False, bands=True),
+    'mixed': dict(size=(2000, 3000), lines=40, fonts=3, images=('png', 'jpeg'), background=True, bands=False),
+    'svg': dict(size=(2000, 3000), lines=20, fonts=2, images=('svg', 'svg'), background=False, bands=False),
+    'print': dict(size=(7200, 10800), lines=60, fonts=3, images=('png', 'jpeg'), background=True, bands=False),
+}
+
+SIZE_MODIFIERS = ['', '', '', 'size=bigger ', 'size=bigger size=bigger ', 'size=smaller ', 'size=smaller size=smaller ']
+ALIGNMENTS = ['', '', 'alignment=left ', 'alignment=right ']
+COLORS = ['', '', 'color=#333333 ', 'color=darkred ', 'color=navy ']
+WORDS = '''poster gallery summer evening concert river light garden festival market
+harbour station winter morning lecture museum library theatre island mountain
+opening night special guest tickets available doors open free entry all welcome'''.split()
+ENCODE_FORMATS = ('png', 'jpeg')
+DATE_FORMAT = '%m/%d/%Y'
+# Phases that get slower by less than this are never reported, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.002
+# The fast background decode must stay this close to a full decode, in dB of PSNR,
+# and may not lose more than QUALITY_TOLERANCE_DB against the --compare baseline
+MIN_BACKGROUND_PSNR = 40.0
+QUALITY_TOLERANCE_DB = 1.0
+# Band heights that cut through most lines of text at some band edge
+BAND_CHECK_HEIGHTS = (37, 64, 100)
+
+
+def make_images(directory):
+    size = (3000, 2000)
+    photo = Image.merge('RGB', [
+        Image.effect_noise(size, 40),
+        Image.linear_gradient('L').resize(size),
+        Image.radial_gradient('L').resize(size),
+    ])
+    photo.save(os.path.join(directory, 'photo.jpg'), quality=90)
+    photo.resize((3000, 4500)).save(os.path.join(directory, 'background.jpg'), quality=90)
+
+    logo = Image.new('RGBA', (800, 800), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(logo)
+    draw.ellipse((50, 50, 750, 750), fill=(200, 40, 40, 255))
+    draw.rectangle((250, 250, 550, 550), fill=(255, 255, 255, 200))
+    logo.save(os.path.join(directory, 'logo.png'))
+
+    with open(os.path.join(directory, 'logo.svg'), 'w') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" width="400" height="300" viewBox="0 0 400 300">\n')
+        f.write('<rect x="10" y="10" width="380" height="280" rx="30" fill="#2255aa"/>\n')
+        f.write('<circle cx="200" cy="150" r="100" fill="#ffcc00" stroke="#222222" stroke-width="8"/>\n')
+        f.write('<path d="M 60 250 L 200 60 L 340 250 Z" fill="none" stroke="#ffffff" stroke-width="6"/>\n')
+        f.write('</svg>\n')
+
+def pick_fonts(font_map, count):
+    # Evenly spaced through the sorted names, so the choice only depends on the installed fonts
+    names = sorted(font_map)
+    if not names or not count:
+        return []
+    step = max(1, len(names) // count)
+    return names[::step][:count]
+
+def make_poster_lines(name, scenario, fonts, directory):
+    rng = random.Random(name)
+    width, height = scenario['size']
+    lines = [f'!size {width}x{height}', '!margin 5%']
+    if scenario['background']:
+        lines.append(f"!background_image {os.path.join(directory, 'background.jpg')}")
+
+    image_files = {'png': 'logo.png', 'jpeg': 'photo.jpg', 'svg': 'logo.svg'}
+    images = list(scenario['images'])
+    font_every = max(1, scenario['lines'] // max(1, len(fonts)))
+    image_every = max(1, scenario['lines'] // (len(images) + 1))
+
+    for i in range(scenario['lines']):
+        if fonts and i % font_every == 0:
+            lines.append(f'!font {fonts[(i // font_every) % len(fonts)]}')
+        if i == 0:
+            lines.append('size=biggest ' + ' '.join(rng.choice(WORDS) for _ in range(2)).title())
+        if images and i and i % image_every == 0:
+            lines.append(f'{os.path.join(directory, image_files[images.pop(0)])} height={rng.choice([8, 10, 15])}%')
+        if rng.random() < 0.1:
+            lines.append('')
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 9))).capitalize()
+        lines.append(rng.choice(ALIGNMENTS) + rng.choice(SIZE_MODIFIERS) + rng.choice(COLORS) + text)
+    return [line + '\n' for line in lines]
+
+def clear_caches():
+    postergen.load_font.cache_clear()
+    postergen.measure_text.cache_clear()
+    postergen.text_metrics.cache_clear()
+    postergen.asset_cache.clear()
+    postergen.text_mask_cache.clear()
+
+def time_call(timings, name, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[name] += time.perf_counter() - start
+    return result
+
+def time_font_map(repeat):
+    samples = collections.defaultdict(list)
+    get_cache_dir = postergen.get_cache_dir
+    try:
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                postergen.get_cache_dir = lambda: cache_dir
+                for name in ('font_map.scan', 'font_map.index'):
+                    start = time.perf_counter()
+                    font_map = postergen.get_font_map()
+                    samples[name].append(time.perf_counter() - start)
+    finally:
+        postergen.get_cache_dir = get_cache_dir
+    return samples, font_map
+
+def run_scenario(lines, date_format):
+    # One cold run: every cache is emptied first, so fonts are loaded, text is
+    # measured and images are decoded again, as in a fresh process
+    clear_caches()
+    timings = collections.defaultdict(float)
+    postergen.start_profile()
+    try:
+        font_map = time_call(timings, 'resolve_fonts', postergen.resolve_font_names, postergen.get_font_names(lines))
+        poster = time_call(timings, 'parse', postergen.parse_poster, lines, date_format, font_map)
+        layout = time_call(timings, 'layout', postergen.layout_poster, poster)
+        image = time_call(timings, 'draw', postergen.draw_region, poster, layout, 0, poster.height)
+        for output_format in ENCODE_FORMATS:
+            time_call(timings, f'encode.{output_format}', image.save, io.BytesIO(), output_format)
+    finally:
+        profile = postergen.stop_profile()
+    # The profile adds the layout passes, font loading, text measurement and image decoding
+    for phase, seconds in profile.totals().items():
+        timings[phase] += seconds
+    return timings
+
+def psnr(image, reference):
+    mse = statistics.mean(rms ** 2 for rms in ImageStat.Stat(ImageChops.difference(image, reference)).rms)
+    # Identical images are reported as 100 dB, which keeps the JSON output standard
+    return 100.0 if mse == 0 else min(100.0, 10 * math.log10(255 ** 2 / mse))
+
+def background_quality(path, size):
+    # The reduced-scale decode of load_background() against decoding the whole
+    # image and resizing it, at the poster size and at a quarter of it, which is
+    # small enough for the JPEG decoder to draft. The caches are cleared so the
+    # background is decoded again at each size.
+    quality = {}
+    for width, height in (size, (size[0] // 4, size[1] // 4)):
+        clear_caches()
+        fast = postergen.load_background(path, (width, height))
+        with Image.open(path) as img:
+            full = img.resize((width, height)).convert('RGB')
+        quality[f'background.psnr.{width}x{height}'] = psnr(fast, full)
+    clear_caches()
+    return quality
+
+def band_differences(lines, date_format, font_map):
+    # The number of pixels in which --band-height output differs from the full render,
+    # for each of BAND_CHECK_HEIGHTS. Anything but 0 means text or images shift at band edges.
+    poster = postergen.parse_poster(lines, date_format, font_map)
+    layout = postergen.layout_poster(poster)
+    full = postergen.draw_region(poster, layout, 0, poster.height)
+    differences = {}
+    for band_height in BAND_CHECK_HEIGHTS:
+        buffer = io.BytesIO()
+        postergen.render_bands(poster, layout, [(buffer, 'png')], band_height, postergen.EncoderOptions(compress_level=1))
+        buffer.seek(0)
+        with Image.open(buffer) as banded:
+            difference = ImageChops.difference(full, banded.convert('RGB'))
+        red, green, blue = difference.split()
+        changed = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+        differences[str(band_height)] = changed.point(lambda value: 1 if value else 0).histogram()[1]
+    return differences
+
+def summarize(samples):
+    return {name: {'median': statistics.median(values), 'min': min(values)} for name, values in sorted(samples.items())}
+
+def run_benchmarks(scenario_names, repeat, date_format):
+    results = {}
+    quality = {}
+    bands = {}
+    font_samples, font_map = time_font_map(repeat)
+    results['fonts'] = summarize(font_samples)
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_images(directory)
+        for name in scenario_names:
+            scenario = SCENARIOS[name]
+            lines = make_poster_lines(name, scenario, pick_fonts(font_map, scenario['fonts']), directory)
+            samples = collections.defaultdict(list)
+            for _ in range(repeat):
+                for phase, seconds in run_scenario(lines, date_format).items():
+                    samples[phase].append(seconds)
+            results[name] = summarize(samples)
+            print(f'{name}: ' + ', '.join(f"{phase} {timing['median'] * 1000:.1f}ms" for phase, timing in results[name].items()), file=sys.stderr, flush=True)
+            if scenario['background']:
+                quality[name] = background_quality(os.path.join(directory, 'background.jpg'), scenario['size'])
+                print(f'{name}: ' + ', '.join(f'{measure} {db:.1f}dB' for measure, db in quality[name].items()), file=sys.stderr, flush=True)
+            if scenario['bands']:
+                bands[name] = band_differences(lines, date_format, postergen.resolve_font_names(postergen.get_font_names(lines)))
+                print(f'{name}: ' + ', '.join(f'bands of {height} differ in {count} pixels' for height, count in bands[name].items()), file=sys.stderr, flush=True)
+    return results, quality, bands
+
+def compare_results(results, baseline, threshold):
+    regressions = []
+    for scenario, phases in results.items():
+        for phase, timing in phases.items():
+            previous = baseline.get(scenario, {}).get(phase)
+            if previous is None:
+                continue
+            before, after = previous['median'], timing['median']
+            if after - before > MIN_REGRESSION_SECONDS and after > before * (1 + threshold):
+                regressions.append((scenario, phase, before, after))
+    return regressions
+
+def check_quality(quality, baseline):
+    # Fails below the floor in every run, and against a baseline, on a drop beyond the tolerance
+    failures = []
+    for scenario, measures in quality.items():
+        for measure, db in measures.items():
+            previous = baseline.get(scenario, {}).get(measure)
+            if db < MIN_BACKGROUND_PSNR or (previous is not None and db < previous - QUALITY_TOLERANCE_DB):
+                failures.append((scenario, measure, previous, db))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each phase of rendering synthetic posters.')
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file instead of standard output.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='Run only this scenario. Can be given more than once. Defaults to all of them.')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of cold runs of each scenario. The median is reported.')
+    parser.add_argument('--draw-threads', type=int, default=0, help='Draw each poster with this many threads, as with postergen.py --draw-threads.')
+    parser.add_argument('--compare', help='A results file from an earlier run. Exits with an error if any phase got slower by more than the threshold.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='The allowed slowdown for --compare, as a fraction of the baseline. The default is 0.1.')
+    args = parser.parse_args()
+    postergen.start_draw_threads(args.draw_threads)
+
+    results = {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'draw_threads': args.draw_threads,
+    }
+    results['results'], results['quality'], results['bands'] = run_benchmarks(args.scenario or list(SCENARIOS), args.repeat, DATE_FORMAT)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    quality_failures = check_quality(results['quality'], baseline.get('quality', {}))
+    for scenario, measure, before, after in quality_failures:
+        was = f' (was {before:.1f}dB)' if before is not None else ''
+        print(f'QUALITY {scenario} {measure}: {after:.1f}dB{was}, the floor is {MIN_BACKGROUND_PSNR:.1f}dB', file=sys.stderr)
+
+    band_failures = [(scenario, height, count) for scenario, counts in results['bands'].items() for height, count in counts.items() if count]
+    for scenario, height, count in band_failures:
+        print(f'BANDS {scenario}: bands of {height} rows differ from the full render in {count} pixels', file=sys.stderr)
+
+    regressions = []
+    if args.compare:
+        regressions = compare_results(results['results'], baseline['results'], args.threshold)
+        for scenario, phase, before, after in regressions:
+            print(f'REGRESSION {scenario} {phase}: {before * 1000:.1f}ms -> {after * 1000:.1f}ms ({after / before - 1:+.0%})', file=sys.stderr)
+        if not regressions:
+            print(f'No phase regressed by more than {args.threshold:.0%}.', file=sys.stderr)
+    if regressions or quality_failures or band_failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
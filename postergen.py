@@ -1,14 +1,174 @@
 import argparse
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import functools
 import os
 import glob
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import re
+import shutil
+import struct
 import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    import resource
+except ImportError:
+    resource = None
+from xml.sax.saxutils import escape, quoteattr
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFont
 from svglib.svglib import svg2rlg
-from reportlab.graphics import renderPM
+from reportlab.graphics import renderPDF, renderPM
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFError, TTFont
+from reportlab.pdfgen import canvas
 
-def get_font_map():
-    font_map = {}
+FONT_INDEX_VERSION = 2
+FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc')
+FONT_CACHE_SIZE = 256
+TEXT_CACHE_SIZE = 4096
+REFERENCE_FONT_SIZE = 1000
+FIT_ITERATIONS = 5
+ASSET_CACHE_BYTES = 512 * 1024 * 1024
+TEXT_MASK_CACHE_BYTES = 64 * 1024 * 1024
+RENDER_CACHE_BYTES = 1024 * 1024 * 1024
+# Images are decoded at no less than this multiple of their final size, see Image.resize()
+DECODE_REDUCING_GAP = 2.0
+WATCH_INTERVAL = 0.1
+LATENCY_SAMPLES = 1000
+PYRAMID_PROBE_ROWS = 256
+
+# The active Profiler, if any. With none, each instrumented phase costs one global check.
+profiler = None
+
+def phase_start():
+    if profiler is not None:
+        return time.perf_counter()
+
+def phase_end(name, start, args=None):
+    # Returns the start of the next phase, so consecutive phases can be chained
+    if start is not None and profiler is not None:
+        now = time.perf_counter()
+        profiler.add(name, start, now, args)
+        return now
+
+def peak_memory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def cache_counts():
+    counts = {'asset': (asset_cache.hits, asset_cache.misses), 'text_mask': (text_mask_cache.hits, text_mask_cache.misses)}
+    for name, function in (('font', load_font), ('text', measure_text), ('text_metrics', text_metrics)):
+        info = function.cache_info()
+        counts[name] = (info.hits, info.misses)
+    return counts
+
+class Profiler:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.memory = []
+        self.initial_cache_counts = cache_counts()
+        self.cache_counts = None
+        self.peak_memory = None
+
+    def add(self, name, start, end, args=None):
+        self.events.append((name, start, end, threading.get_native_id(), args))
+        memory = peak_memory()
+        if memory is not None and (not self.memory or memory > self.memory[-1][1]):
+            self.memory.append((end, memory))
+
+    def finish(self):
+        counts = cache_counts()
+        self.cache_counts = {name: (hits - self.initial_cache_counts[name][0], misses - self.initial_cache_counts[name][1]) for name, (hits, misses) in counts.items()}
+        self.peak_memory = peak_memory()
+
+    def totals(self):
+        totals = collections.defaultdict(float)
+        for name, start, end, _, _ in self.events:
+            totals[name] += end - start
+        return totals
+
+    def trace(self):
+        # Chrome trace-event format, which chrome://tracing and Perfetto both open
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'postergen'}}]
+        for name, start, end, tid, args in self.events:
+            event = {'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+            if args:
+                event['args'] = args
+            events.append(event)
+        for when, memory in self.memory:
+            events.append({'name': 'memory', 'ph': 'C', 'pid': pid, 'ts': (when - self.origin) * 1e6, 'args': {'peak_rss_mb': round(memory / 2 ** 20, 1)}})
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'peak_memory_bytes': self.peak_memory,
+                'cache_hits': {name: hits for name, (hits, _) in self.cache_counts.items()},
+                'cache_misses': {name: misses for name, (_, misses) in self.cache_counts.items()},
+            },
+        }
+
+    def summary(self):
+        totals = self.totals()
+        calls = collections.Counter(name for name, _, _, _, _ in self.events)
+        lines = [f"{'phase':<20} {'calls':>7} {'total ms':>10}"]
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]):
+            lines.append(f'{name:<20} {calls[name]:>7} {total * 1000:>10.1f}')
+        lines.append('')
+        lines.append(f"{'cache':<20} {'hits':>7} {'misses':>10} {'hit rate':>9}")
+        for name, (hits, misses) in self.cache_counts.items():
+            rate = f'{hits / (hits + misses):.0%}' if hits + misses else '-'
+            lines.append(f'{name:<20} {hits:>7} {misses:>10} {rate:>9}')
+        if self.peak_memory is not None:
+            lines.append('')
+            lines.append(f'Peak memory: {self.peak_memory / 2 ** 20:.1f} MB')
+        return '\n'.join(lines)
+
+def start_profile():
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+def stop_profile():
+    global profiler
+    finished, profiler = profiler, None
+    finished.finish()
+    return finished
+
+
+def get_cache_dir():
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~/AppData/Local')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'postergen')
+
+def get_font_index_path():
+    return os.path.join(get_cache_dir(), 'fonts.json')
+
+def get_font_dirs():
     font_paths = ['./']
     if os.name == 'posix':
         font_paths.extend([
@@ -16,32 +176,365 @@ def get_font_map():
             '/usr/local/share/fonts/',
             os.path.expanduser('~/.fonts'),
         ])
+    return font_paths
 
-    for path in font_paths:
-        for font_file in glob.glob(os.path.join(path, '**/*.ttf'), recursive=True):
-            try:
-                font = ImageFont.truetype(font_file)
-                font_map[f'{font.getname()[0]} {font.getname()[1]}'] = font_file
-            except OSError:
-                pass
-        for font_file in glob.glob(os.path.join(path, '**/*.otf'), recursive=True):
-            try:
-                font = ImageFont.truetype(font_file)
-                font_map[f'{font.getname()[0]} {font.getname()[1]}'] = font_file
-            except OSError:
-                pass
-        for font_file in glob.glob(os.path.join(path, '**/*.ttc'), recursive=True):
+def find_font_files():
+    # Ordered like the original scan, so later directories still win on name clashes
+    font_files = []
+    seen = set()
+    for path in get_font_dirs():
+        for ext in FONT_EXTENSIONS:
+            for font_file in glob.glob(os.path.join(path, '**/*' + ext), recursive=True):
+                font_file = os.path.abspath(font_file)
+                if font_file not in seen:
+                    seen.add(font_file)
+                    font_files.append(font_file)
+    return font_files
+
+def decode_sfnt_name(raw, platform_id):
+    # Mirrors FreeType, which is where ImageFont.getname() gets its names:
+    # names are reduced to ASCII and anything else becomes '?'
+    if platform_id == 1:
+        codes = raw
+    else:
+        codes = [int.from_bytes(raw[i:i + 2], 'big') for i in range(0, len(raw) - 1, 2)]
+    chars = []
+    for code in codes:
+        if code == 0:
+            break
+        chars.append(chr(code) if 32 <= code <= 127 else '?')
+    return ''.join(chars)
+
+def read_sfnt_face_name(f, offset):
+    f.seek(offset + 4)
+    num_tables = struct.unpack('>H', f.read(2))[0]
+    f.seek(offset + 12)
+    directory = f.read(16 * num_tables)
+    tables = {}
+    for i in range(num_tables):
+        tag, _, table_offset, length = struct.unpack_from('>4sLLL', directory, 16 * i)
+        tables[tag] = (table_offset, length)
+    if b'name' not in tables:
+        return None
+
+    wws = False
+    if b'OS/2' in tables and tables[b'OS/2'][1] >= 64:
+        f.seek(tables[b'OS/2'][0] + 62)
+        wws = bool(struct.unpack('>H', f.read(2))[0] & 256)
+
+    name_offset = tables[b'name'][0]
+    f.seek(name_offset)
+    _, count, string_offset = struct.unpack('>HHH', f.read(6))
+    records = f.read(12 * count)
+
+    def get_name(name_id):
+        found_win = found_apple_english = found_apple_roman = found_unicode = None
+        for i in range(count):
+            platform_id, encoding_id, language_id, rec_name_id, length, rec_offset = struct.unpack_from('>6H', records, 12 * i)
+            if rec_name_id != name_id or length == 0:
+                continue
+            rec = (platform_id, length, rec_offset)
+            if platform_id == 0:
+                found_unicode = rec
+            elif platform_id == 1:
+                if language_id == 0:
+                    found_apple_english = rec
+                elif encoding_id == 0:
+                    found_apple_roman = rec
+            elif platform_id == 3 and encoding_id in (0, 1, 10):
+                if found_win is None or (language_id & 0x3FF) == 0x009:
+                    found_win = rec
+        rec = found_win or found_apple_english or found_apple_roman or found_unicode
+        if rec is None:
+            return None
+        platform_id, length, rec_offset = rec
+        f.seek(name_offset + string_offset + rec_offset)
+        return decode_sfnt_name(f.read(length), platform_id) or None
+
+    if wws:
+        family = get_name(16) or get_name(1)
+        style = get_name(17) or get_name(2)
+    else:
+        family = get_name(21) or get_name(16) or get_name(1)
+        style = get_name(22) or get_name(17) or get_name(2)
+    if not family or not style:
+        return None
+    return f'{family} {style}'
+
+def read_font_faces(font_file):
+    # Reads the face names straight from the name table instead of handing every
+    # face to FreeType, which is most of the cost of finding fonts
+    with open(font_file, 'rb') as f:
+        if f.read(4) == b'ttcf':
+            f.seek(8)
+            num_fonts = struct.unpack('>L', f.read(4))[0]
+            offsets = struct.unpack(f'>{num_fonts}L', f.read(4 * num_fonts))[:100]
+            specs = [f'{font_file}:{i}' for i in range(len(offsets))]
+        else:
+            offsets = (0,)
+            specs = [font_file]
+        faces = []
+        for offset, font_spec in zip(offsets, specs):
+            name = read_sfnt_face_name(f, offset)
+            if name is None:
+                raise ValueError(f'No usable name table in {font_spec}')
+            faces.append((name, font_spec))
+    return faces
+
+def scan_font_file(font_file):
+    try:
+        return read_font_faces(font_file)
+    except (OSError, ValueError, struct.error):
+        pass
+
+    faces = []
+    if font_file.endswith('.ttc'):
+        # For TTC files, we need to iterate through the fonts in the collection
+        for i in range(100): # Try up to 100 fonts in a collection
             try:
-                # For TTC files, we need to iterate through the fonts in the collection
-                font_collection = ImageFont.truetype(font_file)
-                for i in range(100): # Try up to 100 fonts in a collection
-                    try:
-                        font = ImageFont.truetype(font_file, index=i)
-                        font_map[f'{font.getname()[0]} {font.getname()[1]}'] = f"{font_file}:{i}"
-                    except OSError:
-                        break
+                font = ImageFont.truetype(font_file, index=i)
+                faces.append((f'{font.getname()[0]} {font.getname()[1]}', f'{font_file}:{i}'))
             except OSError:
-                pass
+                break
+    else:
+        try:
+            font = ImageFont.truetype(font_file)
+            faces.append((f'{font.getname()[0]} {font.getname()[1]}', font_file))
+        except OSError:
+            pass
+    return faces
+
+def load_font_index():
+    try:
+        with open(get_font_index_path(), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict) or index.get('version') != FONT_INDEX_VERSION:
+        return {}
+    return index.get('fonts', {})
+
+def save_font_index(fonts):
+    index_path = get_font_index_path()
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': FONT_INDEX_VERSION, 'fonts': fonts}, f)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Warning: Could not write font cache to {index_path}: {e}")
+
+def scan_font_files(font_files):
+    # A cold scan of a large font tree is dominated by opening and reading every file,
+    # so spread it over all cores once there is enough work to pay for the processes
+    if len(font_files) < 64 or (os.cpu_count() or 1) < 2:
+        return [scan_font_file(font_file) for font_file in font_files]
+    try:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            return list(executor.map(scan_font_file, font_files, chunksize=16))
+    except (OSError, concurrent.futures.BrokenExecutor):
+        return [scan_font_file(font_file) for font_file in font_files]
+
+def update_font_index(rebuild=False):
+    cached = {} if rebuild else load_font_index()
+    fonts = {}
+    stale = []
+    for font_file in find_font_files():
+        try:
+            st = os.stat(font_file)
+        except OSError:
+            continue
+        entry = cached.get(font_file)
+        if entry and entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+            fonts[font_file] = entry
+        else:
+            fonts[font_file] = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'faces': []}
+            stale.append(font_file)
+
+    for font_file, faces in zip(stale, scan_font_files(stale)):
+        fonts[font_file]['faces'] = [list(face) for face in faces]
+
+    if rebuild or stale or len(fonts) != len(cached):
+        save_font_index(fonts)
+    return fonts
+
+def get_font_map(rebuild=False):
+    font_map = {}
+    for entry in update_font_index(rebuild).values():
+        for name, font_spec in entry['faces']:
+            font_map[name] = font_spec
+    return font_map
+
+def split_font_spec(font_spec):
+    path, sep, index = font_spec.rpartition(':')
+    if sep and index.isdigit():
+        return path, int(index)
+    return font_spec, 0
+
+# FreeType faces are keyed by (path, index, size) and kept for the life of the
+# process, so every layout pass, the draw loop and later posters share them
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path, font_index, font_size):
+    start = phase_start()
+    font = ImageFont.truetype(font_path, size=font_size, index=font_index)
+    phase_end('font.load', start, {'path': font_path, 'size': font_size})
+    return font
+
+missing_fonts = set()
+
+def get_font(font_spec, font_size):
+    font_path, font_index = split_font_spec(font_spec)
+    try:
+        return load_font(font_path, font_index, font_size)
+    except OSError:
+        if font_spec not in missing_fonts:
+            missing_fonts.add(font_spec)
+            print(f"Warning: Font file not found at {font_spec}. Using default font.")
+        return ImageFont.load_default()
+
+# Text is measured on a throwaway 1x1 canvas, so textbbox() behaves exactly as it
+# would on the poster. Results are cached because a line that is the same from one
+# poster to the next (or one layout pass to the next) never needs measuring twice.
+measure_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def measure_text(font_spec, font_size, text):
+    font = get_font(font_spec, font_size)
+    start = phase_start()
+    bbox = measure_draw.textbbox((0, 0), text, font=font)
+    phase_end('text.measure', start)
+    return bbox
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def text_metrics(font_spec, text):
+    # The bounding box per unit of font size, from a single measurement at a large size
+    return tuple(value / REFERENCE_FONT_SIZE for value in measure_text(font_spec, REFERENCE_FONT_SIZE, text))
+
+def fit_font_size(font_spec, texts, max_width, max_height, max_size=None):
+    # Text extents grow almost linearly with the font size, so the reference metrics give
+    # a near-exact first guess. Hinting moves lines by a pixel or two either way, so the
+    # guess is refined against real measurements, narrowing in on the largest size that
+    # fits from both sides.
+    max_size = max_size or max_height
+    unit_width = max(text_metrics(font_spec, text)[2] for text in texts)
+    unit_height = max(text_metrics(font_spec, text)[3] for text in texts)
+    size = max_size
+    if unit_width > 0:
+        size = min(size, max_width / unit_width)
+    if unit_height > 0:
+        size = min(size, max_height / unit_height)
+    size = max(int(size), 1)
+
+    fits = None
+    too_big = None
+    for _ in range(FIT_ITERATIONS):
+        text_width = max(measure_text(font_spec, size, text)[2] for text in texts)
+        text_height = max(measure_text(font_spec, size, text)[3] for text in texts)
+        scale_factor = min(max_width / text_width if text_width > 0 else 2, max_height / text_height if text_height > 0 else 2)
+        if text_width <= max_width and text_height <= max_height:
+            fits = size
+            size = min(max(int(size * scale_factor), size + 1), max_size)
+        else:
+            too_big = size
+            size = min(int(size * scale_factor), size - 1)
+        if too_big is not None:
+            size = min(size, too_big - 1)
+        if fits is not None:
+            size = max(size, fits + 1)
+        if size < 1 or size > max_size or size == too_big:
+            break
+    return fits or max(size, 1)
+
+def is_font_file_spec(font_name):
+    path = split_font_spec(font_name)[0]
+    return path.lower().endswith(FONT_EXTENSIONS) or os.path.isfile(path)
+
+def font_name_tokens(name):
+    return [token for token in re.split(r'[^a-z0-9]+', name.lower()) if token]
+
+def rank_font_files(font_files, names):
+    # Font files are usually named after their family, so look at the likeliest
+    # candidates first and only fall back to the rest if a name is still missing.
+    # Later files win name clashes, as in get_font_map(), so equally likely
+    # candidates are tried from the last one back.
+    wanted = [font_name_tokens(name) for name in names]
+    def score(font_file):
+        stem = re.sub(r'[^a-z0-9]', '', os.path.splitext(os.path.basename(font_file))[0].lower())
+        best = 0
+        for tokens in wanted:
+            matched = sum(len(token) for token in tokens if token in stem)
+            if tokens and ''.join(tokens[:2]) in stem:
+                matched += 100
+            best = max(best, matched)
+        return best
+    ranked = sorted(enumerate(font_files), key=lambda item: (score(item[1]), item[0]), reverse=True)
+    return [font_file for _, font_file in ranked]
+
+def resolve_font_names(names):
+    wanted = {name for name in names if not is_font_file_spec(name)}
+    font_map = {}
+    if not wanted:
+        return font_map
+
+    # Try what the index already knows, checking only the files it points at
+    fonts = load_font_index()
+    candidates = collections.defaultdict(list)
+    stale = set()
+    for font_file, entry in fonts.items():
+        names = wanted.intersection(name for name, _ in entry['faces'])
+        if not names:
+            continue
+        try:
+            st = os.stat(font_file)
+        except OSError:
+            continue
+        if entry['mtime'] != st.st_mtime_ns or entry['size'] != st.st_size:
+            # A changed file might be the copy that should win, so leave these to the scan
+            stale.update(names)
+            continue
+        for name, font_spec in entry['faces']:
+            if name in names:
+                candidates[name].append((font_file, font_spec))
+    font_files = None
+    for name, found in candidates.items():
+        if name in stale:
+            continue
+        if len(found) > 1:
+            # The same face in several files: the last one in scan order wins, as in
+            # get_font_map(). The index isn't kept in that order, so find it again.
+            if font_files is None:
+                font_files = find_font_files()
+                order = {font_file: i for i, font_file in enumerate(font_files)}
+            found.sort(key=lambda item: order.get(item[0], -1))
+        font_map[name] = found[-1][1]
+    wanted.difference_update(font_map)
+    if not wanted:
+        return font_map
+
+    updated = False
+    for font_file in rank_font_files(font_files or find_font_files(), wanted):
+        try:
+            st = os.stat(font_file)
+        except OSError:
+            continue
+        entry = fonts.get(font_file)
+        if not entry or entry['mtime'] != st.st_mtime_ns or entry['size'] != st.st_size:
+            entry = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'faces': [list(face) for face in scan_font_file(font_file)]}
+            fonts[font_file] = entry
+            updated = True
+        # Within a file, the last face with a name wins too
+        found = {}
+        for name, font_spec in entry['faces']:
+            if name in wanted:
+                found[name] = font_spec
+        font_map.update(found)
+        wanted.difference_update(found)
+        if not wanted:
+            break
+
+    if updated:
+        save_font_index(fonts)
     return font_map
 
 def list_fonts(common_only=False):
@@ -142,23 +635,27 @@ class Poster:
     def __repr__(self):
         return f"Poster(width={self.width}, height={self.height}, margin={self.margin}, font='{self.font}', background_color='{self.background_color}', background_image='{self.background_image}', elements={self.elements})"
 
+# Element records use __slots__, so a poster with thousands of lines, or a long
+# stream of posters, costs a few fixed-size records per line instead of a dict each
 class TextLine:
+    __slots__ = ('text', 'justification', 'size_modifier', 'size', 'color', 'font', 'explicit_font_size', 'is_biggest')
+
     def __init__(self, text, justification='center', size_modifier=0, size=None, color='black', font=None, explicit_font_size=None, is_biggest=False):
         self.text = text
         self.justification = justification
         self.size_modifier = size_modifier
         self.size = size
-        self.height = 0
         self.color = color
         self.font = font
         self.explicit_font_size = explicit_font_size
-        self.calculated_font_size = 0
         self.is_biggest = is_biggest
 
     def __repr__(self):
-        return f"TextLine(text='{self.text}', justification='{self.justification}', size_modifier={self.size_modifier}, size={self.size}, height={self.height}, color='{self.color}', font='{self.font}', is_biggest={self.is_biggest})"
+        return f"TextLine(text='{self.text}', justification='{self.justification}', size_modifier={self.size_modifier}, size={self.size}, color='{self.color}', font='{self.font}', is_biggest={self.is_biggest})"
 
 class ImageElement:
+    __slots__ = ('path', 'width', 'height')
+
     def __init__(self, path, width=None, height=None):
         self.path = path
         self.width = width
@@ -168,12 +665,16 @@ class ImageElement:
         return f"ImageElement(path='{self.path}', width={self.width}, height={self.height})"
 
 class BlankLine:
-    def __init__(self):
-        self.height = 0
+    __slots__ = ()
 
     def __repr__(self):
-        return f"BlankLine(height={self.height})"
+        return "BlankLine()"
 
+def element_fields(element):
+    return {name: getattr(element, name) for name in element.__slots__}
+
+
+IMAGE_EXTENSION = re.compile(r'\.(?:jpg|png|svg)')
 
 def parse_line(line, poster, date_format):
     line = line.strip()
@@ -182,7 +683,6 @@ def parse_line(line, poster, date_format):
     if line.startswith('#'):
         return None
 
-    parts = line.split()
     text_parts = []
     justification = 'center'
     size_modifier = 0
@@ -194,31 +694,32 @@ def parse_line(line, poster, date_format):
 
     is_biggest = False
 
-    is_image = any('.jpg' in p or '.png' in p or '.svg' in p for p in parts)
+    # A line is an image if any of its words mentions an image extension
+    is_image = IMAGE_EXTENSION.search(line) is not None
 
-    for part in parts:
-        if part.startswith('alignment='):
-            justification = part.split('=')[1]
-        elif part.startswith('size='):
-            size_value = part.split('=')[1]
-            if size_value == 'bigger':
+    for part in line.split():
+        key, equals, value = part.partition('=')
+        if not equals:
+            text_parts.append(part)
+        elif key == 'alignment':
+            justification = value
+        elif key == 'size':
+            if value == 'bigger':
                 size_modifier += 1
-            elif size_value == 'smaller':
+            elif value == 'smaller':
                 size_modifier -= 1
-            elif size_value == 'biggest':
+            elif value == 'biggest':
                 is_biggest = True
             else:
-                if size_value.endswith('px'):
-                    size = size_value
-                    explicit_font_size = int(size_value[:-2])
-                else:
-                    size = size_value
-        elif part.startswith('width='):
-            width = part.split('=')[1]
-        elif part.startswith('height='):
-            height = part.split('=')[1]
-        elif part.startswith('color='):
-            color = part.split('=')[1]
+                if value.endswith('px'):
+                    explicit_font_size = int(value[:-2])
+                size = value
+        elif key == 'width':
+            width = value
+        elif key == 'height':
+            height = value
+        elif key == 'color':
+            color = value
         else:
             text_parts.append(part)
 
@@ -228,227 +729,305 @@ def parse_line(line, poster, date_format):
         return ImageElement(" ".join(text_parts), width=width, height=height)
     else:
         text = " ".join(text_parts)
-        text = text.replace("{date}", datetime.now().strftime(date_format))
+        if '{date}' in text:
+            text = text.replace("{date}", datetime.now().strftime(date_format))
         return TextLine(text, justification=justification, size_modifier=size_modifier, size=size, color=color, font=poster.font, explicit_font_size=explicit_font_size, is_biggest=is_biggest)
 
 
-def render_poster(poster, output_filename):
-    if poster.background_image:
-        image = Image.open(poster.background_image)
-        image = image.resize((poster.width, poster.height))
-        image = image.convert('RGB')
+class AssetCache:
+    def __init__(self, max_bytes=ASSET_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load_seconds = 0
+        # Draw threads share the cache. Loads run outside the lock, since they can
+        # use the cache themselves, so two threads may occasionally load the same entry.
+        self.lock = threading.Lock()
+
+    def get(self, key, path, load):
+        # Entries keyed by content rather than by path pass path=None and never go stale
+        mtime = None
+        if path is not None:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        start = time.perf_counter()
+        value, nbytes = load()
+        with self.lock:
+            self.load_seconds += time.perf_counter() - start
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[2]
+            if nbytes <= self.max_bytes:
+                self.entries[key] = (mtime, value, nbytes)
+                self.total_bytes += nbytes
+                while self.total_bytes > self.max_bytes:
+                    _, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted_bytes
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+asset_cache = AssetCache()
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+def thumbnail_size(size, box):
+    # Same arithmetic as Image.thumbnail(), so layout can size an image from its header alone
+    width, height = size
+    x, y = map(math.floor, box)
+    if x >= width and y >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
     else:
-        image = Image.new('RGB', (poster.width, poster.height), poster.background_color)
-    draw = ImageDraw.Draw(image)
-    
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+def file_digest(path):
+    def load():
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest(), 0
+    return asset_cache.get(('digest', path), path, load)
+
+def load_svg(path):
+    def load():
+        start = phase_start()
+        drawing = svg2rlg(path)
+        phase_end('svg.parse', start, {'path': path})
+        if drawing is None:
+            raise IOError(f'Could not parse SVG file {path}')
+        return drawing, os.path.getsize(path) * 4
+    return asset_cache.get(('svg', file_digest(path)), None, load)
+
+def get_image_size(path):
+    def load():
+        if path.endswith('.svg'):
+            drawing = load_svg(path)
+            # renderPM rounds the drawing size to whole pixels at 72 dpi
+            return (int(drawing.width + 0.5), int(drawing.height + 0.5)), 0
+        with Image.open(path) as img:
+            return img.size, 0
+    return asset_cache.get(('size', path), path, load)
+
+def svg_scale(drawing, box):
+    return min(math.floor(box[0]) / drawing.width, math.floor(box[1]) / drawing.height)
+
+def fit_image_size(path, box):
+    if path.endswith('.svg'):
+        # Vector art is rasterized at its final size, so unlike bitmaps it may grow to fill the box
+        drawing = load_svg(path)
+        scale = svg_scale(drawing, box)
+        return int(drawing.width * scale + 0.5), int(drawing.height * scale + 0.5)
+    return thumbnail_size(get_image_size(path), box)
+
+def render_svg(path, box):
+    drawing = load_svg(path)
+    scale = svg_scale(drawing, box)
+    size = (int(drawing.width * scale + 0.5), int(drawing.height * scale + 0.5))
+    def load():
+        start = phase_start()
+        img = renderPM.drawToPIL(drawing, dpi=72 * scale)
+        if img.size != size:
+            img = img.resize(size)
+        phase_end('svg.rasterize', start, {'path': path, 'size': size})
+        return img, image_nbytes(img)
+    return asset_cache.get(('svg_raster', file_digest(path), size), None, load)
+
+def load_image(path, box):
+    if path.endswith('.svg'):
+        return render_svg(path, box)
+    def load():
+        start = phase_start()
+        img = Image.open(path)
+        # thumbnail() drafts JPEGs down to the target size before decoding
+        img.thumbnail(box, reducing_gap=DECODE_REDUCING_GAP)
+        phase_end('image.decode', start, {'path': path})
+        return img, image_nbytes(img)
+    return asset_cache.get(('image', path, box), path, load)
+
+def load_background(path, size):
+    def load():
+        start = phase_start()
+        with Image.open(path) as img:
+            # Decode JPEGs straight at a reduced scale in the DCT domain, then let
+            # resize() box-reduce the rest of the way before the final resample
+            draft = img.draft(None, (int(size[0] * DECODE_REDUCING_GAP), int(size[1] * DECODE_REDUCING_GAP)))
+            img = img.resize(size, box=draft[1] if draft else None, reducing_gap=DECODE_REDUCING_GAP).convert('RGB')
+        phase_end('image.decode', start, {'path': path})
+        return img, image_nbytes(img)
+    return asset_cache.get(('background', path, size), path, load)
+
+def load_background_source(path, size):
+    # The background at the smallest scale the decoder offers that still covers size,
+    # with the region of it that corresponds to the whole original image
+    def load():
+        start = phase_start()
+        img = Image.open(path)
+        draft = img.draft(None, (int(size[0] * DECODE_REDUCING_GAP), int(size[1] * DECODE_REDUCING_GAP)))
+        box = draft[1] if draft else (0, 0, img.width, img.height)
+        img.load()
+        phase_end('image.decode', start, {'path': path})
+        return (img, box), image_nbytes(img)
+    return asset_cache.get(('background_source', path, size), path, load)
+
+def background_band(path, size, top, height):
+    img, (left, upper, right, lower) = load_background_source(path, size)
+    scale = (lower - upper) / size[1]
+    box = (left, upper + top * scale, right, upper + (top + height) * scale)
+    return img.resize((size[0], height), box=box, reducing_gap=DECODE_REDUCING_GAP).convert('RGB')
+
+
+Layout = collections.namedtuple('Layout', ['width', 'height', 'margin_x', 'margin_y', 'placements'])
+Placement = collections.namedtuple('Placement', ['element', 'x', 'y', 'width', 'height', 'font_size'])
+
+def layout_poster(poster):
+    # Works out where everything goes without touching the poster or its elements,
+    # so a poster can be laid out any number of times and checked without rendering.
+    # Heights and font sizes are kept per element index while the passes run.
+    elements = poster.elements
+    heights = [0] * len(elements)
+    font_sizes = [None] * len(elements)
+
     margin_x = int(poster.width * poster.margin)
     margin_y = int(poster.height * poster.margin)
     active_width = poster.width - 2 * margin_x
     active_height = poster.height - 2 * margin_y
 
     # Determine initial heights for all elements
-    explicit_height_elements = []
+    start = phase_start()
     implicit_height_elements = []
     biggest_elements = []
     total_explicit_height = 0
 
-    for element in poster.elements:
+    for i, element in enumerate(elements):
         if isinstance(element, TextLine):
             if element.is_biggest:
-                biggest_elements.append(element)
+                biggest_elements.append(i)
             elif element.explicit_font_size:
-                element.height = element.explicit_font_size  # Use explicit font size as height for initial layout
-                total_explicit_height += element.height
-                explicit_height_elements.append(element)
+                heights[i] = element.explicit_font_size  # Use explicit font size as height for initial layout
+                total_explicit_height += heights[i]
             elif element.size:
                 if element.size.endswith('%'):
-                    element.height = int(active_height * (float(element.size[:-1]) / 100))
+                    heights[i] = int(active_height * (float(element.size[:-1]) / 100))
                 else:
-                    element.height = int(element.size)
-                total_explicit_height += element.height
-                explicit_height_elements.append(element)
+                    heights[i] = int(element.size)
+                total_explicit_height += heights[i]
             else:
-                implicit_height_elements.append(element)
+                implicit_height_elements.append(i)
         elif isinstance(element, ImageElement) and element.height:
             if str(element.height).endswith('%'):
-                element.height = int(active_height * (float(str(element.height)[:-1]) / 100))
+                heights[i] = int(active_height * (float(str(element.height)[:-1]) / 100))
             else:
-                element.height = int(element.height)
-            total_explicit_height += element.height
-            explicit_height_elements.append(element)
+                heights[i] = int(element.height)
+            total_explicit_height += heights[i]
         else:
-            implicit_height_elements.append(element)
-
-    # Calculate font size for biggest elements
-    for element in biggest_elements:
-        font_size = 1000 # Start with a large font size
-        font_name = element.font
-        font_index = 0
-        if ':' in font_name:
-            font_name, font_index = font_name.split(':')
-            font_index = int(font_index)
-        try:
-            font = ImageFont.truetype(font_name, size=font_size, index=font_index)
-        except OSError:
-            print(f"Warning: Font file not found at {element.font}. Using default font.")
-            font = ImageFont.load_default()
-        
-        text_width, _ = draw.textbbox((0,0), element.text, font=font)[2:]
-        scale_factor = active_width / text_width
-        font_size = int(font_size * scale_factor)
-        element.calculated_font_size = font_size
-
-    # Calculate height of biggest elements and add to total_explicit_height
-    for element in biggest_elements:
-        font_name = element.font
-        font_index = 0
-        if ':' in font_name:
-            font_name, font_index = font_name.split(':')
-            font_index = int(font_index)
-        try:
-            font = ImageFont.truetype(font_name, size=element.calculated_font_size, index=font_index)
-        except OSError:
-            print(f"Warning: Font file not found at {element.font}. Using default font.")
-            font = ImageFont.load_default()
-        
-        _, text_height = draw.textbbox((0,0), element.text, font=font)[2:]
-        element.height = text_height
-        total_explicit_height += element.height
-    
-    explicit_height_elements.extend(biggest_elements)
+            implicit_height_elements.append(i)
+
+    # Calculate font size and height of biggest elements and add to total_explicit_height
+    for i in biggest_elements:
+        element = elements[i]
+        font_sizes[i] = fit_font_size(element.font, [element.text], active_width, active_height)
+        _, text_height = measure_text(element.font, font_sizes[i], element.text)[2:]
+        heights[i] = text_height
+        total_explicit_height += text_height
 
     remaining_height = active_height - total_explicit_height
     if implicit_height_elements:
         total_implicit_units = 0
-        for element in implicit_height_elements:
-            if isinstance(element, BlankLine):
+        for i in implicit_height_elements:
+            if isinstance(elements[i], BlankLine):
                 total_implicit_units += 0.25
             else:
                 total_implicit_units += 1
         
         if total_implicit_units > 0:
             unit_height = remaining_height / total_implicit_units
-            for element in implicit_height_elements:
+            for i in implicit_height_elements:
+                element = elements[i]
                 if isinstance(element, BlankLine):
-                    element.height = unit_height * 0.25
+                    heights[i] = unit_height * 0.25
                 elif isinstance(element, TextLine):
-                    element.height = unit_height * (1.2 ** element.size_modifier)
+                    heights[i] = unit_height * (1.2 ** element.size_modifier)
                 else:
-                    element.height = unit_height
+                    heights[i] = unit_height
+
+    start = phase_end('layout.heights', start)
 
     # Group text lines without explicit font sizes by size_modifier and font
     dynamic_text_groups = {}
-    for element in poster.elements:
+    for i, element in enumerate(elements):
         if isinstance(element, TextLine) and not element.explicit_font_size and not element.is_biggest:
             key = (element.size_modifier, element.font)
             if key not in dynamic_text_groups:
                 dynamic_text_groups[key] = []
-            dynamic_text_groups[key].append(element)
+            dynamic_text_groups[key].append(i)
 
     # Calculate font size for each dynamic group
-    dynamic_group_font_sizes = {}
     for key, group in dynamic_text_groups.items():
-        max_text_width = 0
-        for element in group:
-            # Temporarily use element.height to get an initial font size for width calculation
-            temp_font_size = int(element.height * 0.8)
-            if temp_font_size <= 0:
-                temp_font_size = 1
-            font_name = element.font
-            font_index = 0
-            if ':' in font_name:
-                font_name, font_index = font_name.split(':')
-                font_index = int(font_index)
-            try:
-                temp_font = ImageFont.truetype(font_name, size=temp_font_size, index=font_index)
-            except OSError:
-                print(f"Warning: Font file not found at {element.font}. Using default font.")
-                temp_font = ImageFont.load_default()
-            
-            text_width, _ = draw.textbbox((0,0), element.text, font=temp_font)[2:]
-            if text_width > max_text_width:
-                max_text_width = text_width
-        
-        # Calculate base font size for the group based on the longest line
-        base_font_size = int(group[0].height * 0.8) # Use height of first element in group as a reference
+        # The line height caps the group's font size, and the longest line has to fit the width
+        base_font_size = int(heights[group[0]] * 0.8) # Use height of first element in group as a reference
         if base_font_size <= 0:
             base_font_size = 1
-
-        if max_text_width > active_width:
-            scale_factor = active_width / max_text_width
-            base_font_size = int(base_font_size * scale_factor)
-        
-        dynamic_group_font_sizes[key] = base_font_size
-
-    # Assign calculated_font_size to each element
-    for element in poster.elements:
-        if isinstance(element, TextLine):
-            if element.explicit_font_size:
-                element.calculated_font_size = element.explicit_font_size
-            elif not element.is_biggest:
-                key = (element.size_modifier, element.font)
-                element.calculated_font_size = dynamic_group_font_sizes[key]
-
-
+        font_size = fit_font_size(key[1], [elements[i].text for i in group], active_width, active_height, base_font_size)
+        for i in group:
+            font_sizes[i] = font_size
+    start = phase_end('layout.fonts', start)
 
     # Calculate final rendered heights
-    for element in poster.elements:
+    for i, element in enumerate(elements):
         if isinstance(element, TextLine):
-            font_size = element.calculated_font_size
-            try:
-                font_name = element.font
-                font_index = 0
-                if ':' in font_name:
-                    font_name, font_index = font_name.split(':')
-                    font_index = int(font_index)
-                font = ImageFont.truetype(font_name, size=font_size, index=font_index)
-            except OSError:
-                print(f"Warning: Font file not found at {element.font}. Using default font.")
-                font = ImageFont.load_default()
-            _, text_height = draw.textbbox((0,0), element.text, font=font)[2:]
-            element.height = text_height
+            if element.explicit_font_size:
+                font_sizes[i] = element.explicit_font_size
+            _, text_height = measure_text(element.font, font_sizes[i], element.text)[2:]
+            heights[i] = text_height
         elif isinstance(element, ImageElement):
             try:
-                if element.path.endswith('.svg'):
-                    drawing = svg2rlg(element.path)
-                    img = renderPM.drawToPIL(drawing)
-                else:
-                    img = Image.open(element.path)
-                if element.width and not element.height:
+                img_width, img_height = get_image_size(element.path)
+                if element.width and not heights[i]:
                     if str(element.width).endswith('%'):
-                        new_width = int((poster.width - 2 * margin_x) * (float(str(element.width)[:-1]) / 100))
+                        new_width = int(active_width * (float(str(element.width)[:-1]) / 100))
                     else:
                         new_width = int(element.width)
-                    aspect_ratio = img.height / img.width
-                    new_height = int(new_width * aspect_ratio)
-                    element.height = new_height
+                    aspect_ratio = img_height / img_width
+                    heights[i] = int(new_width * aspect_ratio)
                 
-                img.thumbnail((poster.width - 2 * margin_x, element.height))
-                element.height = img.height
+                heights[i] = fit_image_size(element.path, (active_width, heights[i]))[1]
             except IOError:
                 raise IOError(f"Error: Image file not found at {element.path}. Please ensure the image exists and the path is correct.")
 
+    start = phase_end('layout.measure', start)
+
     # Calculate total rendered height and extra whitespace
-    total_rendered_height = sum(element.height for element in poster.elements)
+    total_rendered_height = sum(heights)
     extra_whitespace = active_height - total_rendered_height
     y_cursor = margin_y + extra_whitespace / 2
 
-    # Render all elements
-    for i, element in enumerate(poster.elements):
+    # Place all elements
+    placements = []
+    for i, element in enumerate(elements):
         if isinstance(element, TextLine):
-            font_size = element.calculated_font_size
-            try:
-                font_name = element.font
-                font_index = 0
-                if ':' in font_name:
-                    font_name, font_index = font_name.split(':')
-                    font_index = int(font_index)
-                font = ImageFont.truetype(font_name, size=font_size, index=font_index)
-            except OSError:
-                print(f"Warning: Font file not found at {element.font}. Using default font.")
-                font = ImageFont.load_default()
-
-            text_width, text_height = draw.textbbox((0,0), element.text, font=font)[2:]
+            text_width, text_height = measure_text(element.font, font_sizes[i], element.text)[2:]
             
             x = margin_x
             if element.justification == 'center':
@@ -456,40 +1035,1500 @@ def render_poster(poster, output_filename):
             elif element.justification == 'right':
                 x = poster.width - margin_x - text_width
 
-            draw.text((x, y_cursor), element.text, fill=element.color, font=font)
+            placements.append(Placement(element, x, y_cursor, text_width, text_height, font_sizes[i]))
             y_cursor += text_height
         elif isinstance(element, BlankLine):
-            y_cursor += element.height
+            placements.append(Placement(element, margin_x, y_cursor, active_width, heights[i], None))
+            y_cursor += heights[i]
+        elif isinstance(element, ImageElement):
+            img_width, _ = fit_image_size(element.path, (active_width, heights[i]))
+            x = (poster.width - img_width) / 2
+            placements.append(Placement(element, x, y_cursor, img_width, heights[i], None))
+            y_cursor += heights[i]
+    phase_end('layout.place', start)
+
+    return Layout(poster.width, poster.height, margin_x, margin_y, tuple(placements))
+
+def layout_to_json(layout):
+    placements = []
+    for placement in layout.placements:
+        element = placement.element
+        entry = {
+            'type': type(element).__name__,
+            'x': placement.x,
+            'y': placement.y,
+            'width': placement.width,
+            'height': placement.height,
+        }
+        if isinstance(element, TextLine):
+            entry.update(text=element.text, font=element.font, font_size=placement.font_size, color=element.color)
+        elif isinstance(element, ImageElement):
+            entry['path'] = element.path
+        placements.append(entry)
+    return {
+        'width': layout.width,
+        'height': layout.height,
+        'margin_x': layout.margin_x,
+        'margin_y': layout.margin_y,
+        'elements': placements,
+    }
+
+def placement_rows(placement):
+    # The rows a placement can touch. Glyphs such as accented capitals may
+    # reach above the line's origin, so text uses its ink box.
+    if isinstance(placement.element, TextLine):
+        element = placement.element
+        top, bottom = measure_text(element.font, placement.font_size, element.text)[1::2]
+        return placement.y + min(top, 0), placement.y + bottom
+    return placement.y, placement.y + placement.height
+
+text_mask_cache = AssetCache(TEXT_MASK_CACHE_BYTES)
+
+def text_mask(font_spec, font_size, text, start):
+    # The coverage of a line of text drawn at a position whose fractional part is start,
+    # cropped to its ink, with the offset of the crop from the position's whole pixel.
+    # FreeType rasterizes at the same fractional offset, so pasting the mask matches
+    # draw.text() exactly. Masks don't depend on the color, so every color shares them.
+    def load():
+        font = get_font(font_spec, font_size)
+        left, top, right, bottom = measure_text(font_spec, font_size, text)
+        # The origin has to stay on the canvas, or its fractional part would change sign
+        pad = font_size // 4 + 2
+        x, y = max(0, pad - left), max(0, pad - top)
+        mask = Image.new('L', (x + right + pad, y + bottom + pad))
+        ImageDraw.Draw(mask).text((x + start[0], y + start[1]), text, fill=255, font=font)
+        bbox = mask.getbbox()
+        if bbox is None:
+            return None, 0
+        mask = mask.crop(bbox)
+        return (mask, bbox[0] - x, bbox[1] - y), mask.width * mask.height
+    return text_mask_cache.get((font_spec, font_size, text, start), None, load)
+
+def element_layer(poster, layout, placement, top):
+    # Rasterizes one element on its own, ready to be composited. Elements don't
+    # depend on each other once laid out, so this can run on any thread.
+    element = placement.element
+    start = phase_start()
+    if isinstance(element, TextLine):
+        # Text is a mask and where to paste it, or None without ink. The position is
+        # split on the poster rather than on the band, with floor() so the fraction is
+        # never negative, and every band then cuts the same mask in the same place.
+        x, y = math.floor(placement.x), math.floor(placement.y)
+        mask = text_mask(element.font, placement.font_size, element.text, (placement.x - x, placement.y - y))
+        layer = mask and (mask[0], (x + mask[1], y - top + mask[2]))
+        phase_end('draw.text', start, {'text': element.text, 'size': placement.font_size})
+        return layer
+    try:
+        img = load_image(element.path, (poster.width - 2 * layout.margin_x, placement.height))
+    except IOError:
+        raise IOError(f"Error: Image file not found at {element.path}. Please ensure the image exists and the path is correct.")
+    phase_end('draw.image', start, {'path': element.path})
+    return img
+
+def composite_layer(image, draw, placement, layer, top):
+    element = placement.element
+    if isinstance(element, TextLine):
+        if layer is not None:
+            draw.bitmap(layer[1], layer[0], fill=element.color)
+    elif layer.mode == 'RGBA':
+        image.paste(layer, (int(placement.x), int(placement.y) - top), layer)
+    else:
+        image.paste(layer, (int(placement.x), int(placement.y) - top))
+
+def draw_background(poster, top, height):
+    start = phase_start()
+    if poster.background_image and top == 0 and height == poster.height:
+        image = load_background(poster.background_image, (poster.width, poster.height)).copy()
+    elif poster.background_image:
+        image = background_band(poster.background_image, (poster.width, poster.height), top, height)
+    else:
+        image = Image.new('RGB', (poster.width, height), poster.background_color)
+    phase_end('draw.background', start)
+    return image
+
+# The thread pool that rasterizes elements in parallel, if any, see start_draw_threads()
+draw_executor = None
+
+def start_draw_threads(threads):
+    global draw_executor
+    draw_executor = concurrent.futures.ThreadPoolExecutor(threads) if threads > 1 else None
+
+def draw_region(poster, layout, top, height):
+    # Draws the rows [top, top + height) of the poster onto a canvas of their own
+    placements = []
+    for placement in layout.placements:
+        if isinstance(placement.element, BlankLine):
+            continue
+        first_row, last_row = placement_rows(placement)
+        if last_row <= top or first_row >= top + height:
+            continue
+        placements.append(placement)
+
+    if draw_executor is None:
+        image = draw_background(poster, top, height)
+        layers = (element_layer(poster, layout, placement, top) for placement in placements)
+    else:
+        # Decoding, resampling and text rasterization run on the pool while the
+        # layers are composited here in layout order, so overlaps come out the same
+        background = draw_executor.submit(draw_background, poster, top, height)
+        futures = [draw_executor.submit(element_layer, poster, layout, placement, top) for placement in placements]
+        image = background.result()
+        layers = (future.result() for future in futures)
+
+    draw = ImageDraw.Draw(image)
+    for placement, layer in zip(placements, layers):
+        composite_layer(image, draw, placement, layer, top)
+    return image
+
+OUTPUT_FORMATS = {
+    '.png': 'png',
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.webp': 'webp',
+    '.tif': 'tiff',
+    '.tiff': 'tiff',
+    '.pdf': 'pdf',
+    '.svg': 'svg',
+}
+
+def get_output_format(output_filename):
+    return OUTPUT_FORMATS.get(os.path.splitext(output_filename)[1].lower())
+
+PNG_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+# Settings left as None keep Pillow's defaults for the format
+EncoderOptions = collections.namedtuple('EncoderOptions', ['compress_level', 'png_strategy', 'quality', 'subsampling', 'tiff_compression'], defaults=(None,) * 5)
+
+def encoder_params(output_format, options):
+    params = {}
+    if output_format == 'png':
+        if options.compress_level is not None:
+            params['compress_level'] = options.compress_level
+        if options.png_strategy:
+            params['compress_type'] = PNG_STRATEGIES[options.png_strategy]
+    elif output_format in ('jpeg', 'webp'):
+        if options.quality is not None:
+            params['quality'] = options.quality
+        if output_format == 'jpeg' and options.subsampling:
+            params['subsampling'] = options.subsampling
+    elif output_format == 'tiff':
+        if options.tiff_compression:
+            params['compression'] = options.tiff_compression
+        if options.quality is not None and options.tiff_compression == 'jpeg':
+            params['quality'] = options.quality
+    return params
+
+def save_image(image, output, output_format, encoder_options=None):
+    start = phase_start()
+    image.save(output, format=output_format, **encoder_params(output_format, encoder_options or EncoderOptions()))
+    phase_end('encode', start, {'format': output_format})
+
+def render_poster(poster, output, band_height=None, output_format=None, encoder_options=None, encoder=None, layout=None, image=None):
+    # output is a file name, a list of file names, or a binary file object, for which
+    # the format must be given. Every raster output is encoded from the same canvas.
+    # With an encoder thread pool, the encodes are handed to it and their futures returned.
+    # A layout and canvas already made for this poster can be passed in.
+    outputs = output if isinstance(output, list) else [output]
+    formats = [output_format or get_output_format(item) for item in outputs]
+    start = phase_start()
+    if layout is None and (image is None or 'pdf' in formats or 'svg' in formats):
+        layout = layout_poster(poster)
+        start = phase_end('layout', start)
+    raster_outputs = []
+    for item, item_format in zip(outputs, formats):
+        if item_format == 'pdf':
+            write_pdf(poster, layout, item)
+            start = phase_end('write.pdf', start)
+        elif item_format == 'svg':
+            write_svg(poster, layout, item)
+            start = phase_end('write.svg', start)
+        else:
+            raster_outputs.append((item, item_format))
+    if not raster_outputs:
+        return []
+    if band_height and image is None:
+        render_bands(poster, layout, raster_outputs, band_height, encoder_options)
+        return []
+    if image is None:
+        image = draw_region(poster, layout, 0, poster.height)
+        phase_end('draw', start)
+    if encoder is not None:
+        return [encoder.submit(save_image, image, item, item_format, encoder_options) for item, item_format in raster_outputs]
+    for item, item_format in raster_outputs:
+        save_image(image, item, item_format, encoder_options)
+    return []
+
+def resized_poster(poster, size):
+    resized = copy.copy(poster)
+    resized.width, resized.height = size
+    return resized
+
+def sized_output_name(template, size):
+    width, height = size
+    if any(field in template for field in ('{width}', '{height}', '{size}')):
+        return template.replace('{width}', str(width)).replace('{height}', str(height)).replace('{size}', f'{width}x{height}')
+    stem, extension = os.path.splitext(template)
+    return f'{stem}-{width}x{height}{extension}'
+
+def scales_with_size(poster):
+    # Whether a smaller render of the poster is just a scaled-down copy of a larger
+    # one, which holds when the margin and every element size are relative
+    if not isinstance(poster.margin, float):
+        return False
+    for element in poster.elements:
+        if isinstance(element, TextLine) and element.size and not element.size.endswith('%'):
+            return False
+        if isinstance(element, ImageElement):
+            for value in (element.width, element.height):
+                if value and not str(value).endswith('%'):
+                    return False
+    return True
+
+class Pyramid:
+    # Successive halvings of a canvas, built as they are first needed and shared by
+    # every output size taken from it
+    def __init__(self, image):
+        self.levels = [image]
+        # Timing a strip of rows tells how fast this machine halves and resamples images
+        probe = image.crop((0, 0, image.width, min(image.height, PYRAMID_PROBE_ROWS)))
+        pixels = probe.width * probe.height
+        start = time.perf_counter()
+        half = probe.reduce(2)
+        self.reduce_seconds = (time.perf_counter() - start) / pixels
+        start = time.perf_counter()
+        half.resize((max(1, half.width * 3 // 4), max(1, half.height * 3 // 4)), Image.LANCZOS)
+        self.resample_seconds = (time.perf_counter() - start) / (half.width * half.height)
+
+    def level_sizes(self, size):
+        # The size of every level down to the smallest one that still covers size
+        sizes = [self.levels[0].size]
+        width, height = sizes[0]
+        while (width + 1) // 2 >= size[0] and (height + 1) // 2 >= size[1]:
+            width, height = (width + 1) // 2, (height + 1) // 2
+            sizes.append((width, height))
+        return sizes
+
+    def cost(self, size):
+        # Seconds to halve down to the level for size, then resample that level to size
+        sizes = self.level_sizes(size)
+        seconds = 0
+        for index in range(len(self.levels), len(sizes)):
+            width, height = sizes[index - 1]
+            seconds += width * height * self.reduce_seconds
+        width, height = sizes[-1]
+        return seconds + width * height * self.resample_seconds
+
+    def resize(self, size):
+        sizes = self.level_sizes(size)
+        while len(self.levels) < len(sizes):
+            self.levels.append(self.levels[-1].reduce(2))
+        level = self.levels[len(sizes) - 1]
+        if level.size == tuple(size):
+            return level
+        return level.resize(size, Image.LANCZOS)
+
+def render_sizes(poster, targets, resample='auto', encoder_options=None, encoder=None, band_height=None):
+    # targets is a list of (size, output file names). The largest size is rendered in
+    # full. Each smaller raster output is either laid out and drawn again at its own
+    # size, which keeps text hinted and sharp, or resampled from the largest canvas
+    # through a pyramid of halvings, whichever is estimated to be faster.
+    if band_height:
+        # Banded renders never hold a whole canvas to resample from
+        for size, outputs in targets:
+            render_poster(resized_poster(poster, size), outputs, band_height=band_height, encoder_options=encoder_options)
+        return []
+    targets = sorted(targets, key=lambda target: target[0][0] * target[0][1], reverse=True)
+    (size, outputs), smaller = targets[0], targets[1:]
+    largest = resized_poster(poster, size)
+    phase = phase_start()
+    start = time.perf_counter()
+    layout = layout_poster(largest)
+    layout_time = time.perf_counter() - start
+    phase = phase_end('layout', phase)
+    raster = any(get_output_format(output) not in ('pdf', 'svg') for output in outputs + [output for _, outputs in smaller for output in outputs])
+    load_seconds = asset_cache.load_seconds
+    image = draw_region(largest, layout, 0, largest.height) if raster else None
+    draw_time = time.perf_counter() - start - layout_time
+    # Decoding depends more on the size of the source images than of the poster
+    decode_time = asset_cache.load_seconds - load_seconds
+    phase_end('draw', phase)
+    futures = render_poster(largest, outputs, encoder_options=encoder_options, encoder=encoder, layout=layout, image=image)
+
+    pyramid = None
+    scalable = scales_with_size(poster)
+    for size, outputs in smaller:
+        target = resized_poster(poster, size)
+        vector_outputs = [output for output in outputs if get_output_format(output) in ('pdf', 'svg')]
+        raster_outputs = [output for output in outputs if output not in vector_outputs]
+        if vector_outputs:
+            render_poster(target, vector_outputs)
+        if not raster_outputs:
+            continue
+        same_shape = abs(size[0] * largest.height / largest.width - size[1]) <= 1
+        if resample != 'layout' and scalable and same_shape:
+            if pyramid is None:
+                pyramid = Pyramid(image)
+            # Layout is mostly text measurement, which doesn't get cheaper at a smaller size
+            layout_cost = layout_time + decode_time + (draw_time - decode_time) * size[0] * size[1] / (largest.width * largest.height)
+            if resample == 'pyramid' or pyramid.cost(size) < layout_cost:
+                start = phase_start()
+                resized = pyramid.resize(size)
+                phase_end('resize.pyramid', start, {'size': size})
+                futures += render_poster(target, raster_outputs, encoder_options=encoder_options, encoder=encoder, image=resized)
+                continue
+        futures += render_poster(target, raster_outputs, encoder_options=encoder_options, encoder=encoder)
+    return futures
+
+
+def rgb_color(color):
+    return tuple(value / 255 for value in ImageColor.getrgb(color)[:3])
+
+def text_baseline(placement):
+    # draw.text() places the ascender line at y; vector formats place the baseline
+    return get_font(placement.element.font, placement.font_size).getmetrics()[0]
+
+def text_image(placement):
+    # A transparent bitmap of a text line, for fonts a vector format cannot embed
+    element = placement.element
+    left, top, right, bottom = measure_text(element.font, placement.font_size, element.text)
+    img = Image.new('RGBA', (max(right, 1), max(bottom, 1)), (0, 0, 0, 0))
+    ImageDraw.Draw(img).text((0, 0), element.text, fill=element.color, font=get_font(element.font, placement.font_size))
+    return img
+
+pdf_fonts = {}
+
+def get_pdf_font(font_spec):
+    # reportlab embeds TrueType outlines subsetted to the glyphs used. CFF-based
+    # fonts and missing files return None and are drawn as bitmaps instead.
+    font_path, font_index = split_font_spec(font_spec)
+    key = (font_path, font_index)
+    if key not in pdf_fonts:
+        name = f'postergen-{len(pdf_fonts)}'
+        try:
+            pdfmetrics.registerFont(TTFont(name, font_path, subfontIndex=font_index))
+        except (OSError, TTFError):
+            name = None
+        pdf_fonts[key] = name
+    return pdf_fonts[key]
+
+def write_pdf(poster, layout, output):
+    # One poster pixel is one PDF point. Text stays text, SVGs stay vectors and
+    # bitmaps are embedded at their native resolution and scaled by the PDF.
+    c = canvas.Canvas(output, pagesize=(poster.width, poster.height))
+    if poster.background_image:
+        c.drawImage(poster.background_image, 0, 0, width=poster.width, height=poster.height)
+    else:
+        c.setFillColorRGB(*rgb_color(poster.background_color))
+        c.rect(0, 0, poster.width, poster.height, stroke=0, fill=1)
+
+    for placement in layout.placements:
+        element = placement.element
+        if isinstance(element, TextLine):
+            font_name = get_pdf_font(element.font)
+            if font_name:
+                c.setFont(font_name, placement.font_size)
+                c.setFillColorRGB(*rgb_color(element.color))
+                c.drawString(placement.x, poster.height - placement.y - text_baseline(placement), element.text)
+            else:
+                img = text_image(placement)
+                c.drawImage(ImageReader(img), placement.x, poster.height - placement.y - img.height, width=img.width, height=img.height, mask='auto')
         elif isinstance(element, ImageElement):
             try:
+                img_width, img_height = fit_image_size(element.path, (placement.width, placement.height))
+                y = poster.height - placement.y - img_height
                 if element.path.endswith('.svg'):
-                    drawing = svg2rlg(element.path)
-                    img = renderPM.drawToPIL(drawing)
+                    drawing = load_svg(element.path)
+                    c.saveState()
+                    c.translate(placement.x, y)
+                    c.scale(img_width / drawing.width, img_height / drawing.height)
+                    renderPDF.draw(drawing, c, 0, 0)
+                    c.restoreState()
                 else:
-                    img = Image.open(element.path)
-                img.thumbnail((poster.width - 2 * margin_x, element.height))
-                x = (poster.width - img.width) / 2
-                if img.mode == 'RGBA':
-                    image.paste(img, (int(x), int(y_cursor)), img)
-                else:
-                    image.paste(img, (int(x), int(y_cursor)))
-                y_cursor += element.height
+                    c.drawImage(element.path, placement.x, y, width=img_width, height=img_height, mask='auto')
             except IOError:
                 raise IOError(f"Error: Image file not found at {element.path}. Please ensure the image exists and the path is correct.")
+    c.showPage()
+    c.save()
+
+SVG_MIME_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.svg': 'image/svg+xml',
+    '.ttf': 'font/ttf',
+    '.otf': 'font/otf',
+}
+
+def data_uri(path):
+    with open(path, 'rb') as f:
+        data = base64.b64encode(f.read()).decode('ascii')
+    return f'data:{SVG_MIME_TYPES[os.path.splitext(path)[1].lower()]};base64,{data}'
+
+def image_data_uri(img):
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def write_svg(poster, layout, output):
+    # Fonts are embedded whole as @font-face data. Images, including SVGs, are
+    # embedded as the original files, so nothing is rasterized or resampled.
+    font_faces = {}
+    body = []
+    if poster.background_image:
+        body.append(f'<image x="0" y="0" width="{poster.width}" height="{poster.height}" preserveAspectRatio="none" href="{data_uri(poster.background_image)}"/>')
+    else:
+        body.append(f'<rect x="0" y="0" width="{poster.width}" height="{poster.height}" fill={quoteattr(poster.background_color)}/>')
+
+    for placement in layout.placements:
+        element = placement.element
+        if isinstance(element, TextLine):
+            font_path = split_font_spec(element.font)[0]
+            if os.path.splitext(font_path)[1].lower() in ('.ttf', '.otf') and os.path.isfile(font_path):
+                family = font_faces.setdefault(font_path, f'postergen-{len(font_faces)}')
+                body.append(f'<text x="{placement.x}" y="{placement.y + text_baseline(placement)}" font-family="{family}" font-size="{placement.font_size}" fill={quoteattr(element.color)} xml:space="preserve">{escape(element.text)}</text>')
+            else:
+                img = text_image(placement)
+                body.append(f'<image x="{placement.x}" y="{placement.y}" width="{img.width}" height="{img.height}" href="{image_data_uri(img)}"/>')
+        elif isinstance(element, ImageElement):
+            try:
+                img_width, img_height = fit_image_size(element.path, (placement.width, placement.height))
+                body.append(f'<image x="{placement.x}" y="{placement.y}" width="{img_width}" height="{img_height}" preserveAspectRatio="none" href="{data_uri(element.path)}"/>')
+            except (IOError, KeyError):
+                raise IOError(f"Error: Image file not found at {element.path}. Please ensure the image exists and the path is correct.")
+
+    document = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{poster.width}" height="{poster.height}" viewBox="0 0 {poster.width} {poster.height}">']
+    if font_faces:
+        document.append('<style>')
+        for font_path, family in font_faces.items():
+            document.append(f'@font-face {{ font-family: "{family}"; src: url({data_uri(font_path)}); }}')
+        document.append('</style>')
+    document.extend(body)
+    document.append('</svg>\n')
+    data = '\n'.join(document).encode('utf-8')
+    if isinstance(output, str):
+        with open(output, 'wb') as f:
+            f.write(data)
+    else:
+        output.write(data)
+
+
+class PNGStripWriter:
+    # Writes an RGB PNG a band of rows at a time. Every row uses the "Up" filter,
+    # which ImageChops can compute for a whole band at once, and the compressed
+    # stream is flushed out as IDAT chunks as it grows.
+    def __init__(self, f, width, height, compress_level=6, strategy=zlib.Z_DEFAULT_STRATEGY):
+        self.f = f
+        self.width = width
+        self.previous_row = Image.new('RGB', (width, 1))
+        self.compressor = zlib.compressobj(compress_level, strategy=strategy)
+        f.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>LLBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, tag, data):
+        self.f.write(struct.pack('>L', len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack('>L', zlib.crc32(data, zlib.crc32(tag))))
+
+    def write(self, band):
+        above = Image.new('RGB', band.size)
+        above.paste(self.previous_row, (0, 0))
+        above.paste(band.crop((0, 0, band.width, band.height - 1)), (0, 1))
+        self.previous_row = band.crop((0, band.height - 1, band.width, band.height))
+        filtered = ImageChops.subtract_modulo(band, above).tobytes()
+        stride = 3 * self.width
+        raw = b''.join(b'\x02' + filtered[i:i + stride] for i in range(0, len(filtered), stride))
+        data = self.compressor.compress(raw)
+        if data:
+            self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+
+class TIFFStripWriter:
+    # Writes an RGB TIFF with one deflate-compressed strip per band. The strips
+    # go out as they are drawn and the directory describing them goes at the end.
+    def __init__(self, f, width, height, rows_per_strip):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.rows_per_strip = rows_per_strip
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        f.write(b'II*\x00\x00\x00\x00\x00')
+
+    def write(self, band):
+        data = zlib.compress(band.tobytes())
+        self.strip_offsets.append(self.f.tell())
+        self.strip_byte_counts.append(len(data))
+        self.f.write(data)
+
+    def close(self):
+        if self.f.tell() & 1:
+            self.f.write(b'\x00')
+        extra_offset = self.f.tell()
+        count = len(self.strip_offsets)
+        extra = struct.pack('<3H', 8, 8, 8) + struct.pack(f'<{count}L', *self.strip_offsets) + struct.pack(f'<{count}L', *self.strip_byte_counts)
+        ifd_offset = extra_offset + len(extra)
+        if ifd_offset > 0xFFFFFFFF:
+            raise ValueError('Banded TIFF output is limited to 4 GB')
+        self.f.write(extra)
+
+        # Single values are stored in the entry itself, longer arrays are written above
+        strip_offsets = self.strip_offsets[0] if count == 1 else extra_offset + 6
+        strip_byte_counts = self.strip_byte_counts[0] if count == 1 else extra_offset + 6 + 4 * count
+        entries = [
+            (256, 4, 1, self.width),
+            (257, 4, 1, self.height),
+            (258, 3, 3, extra_offset),
+            (259, 3, 1, 8),
+            (262, 3, 1, 2),
+            (273, 4, count, strip_offsets),
+            (277, 3, 1, 3),
+            (278, 4, 1, self.rows_per_strip),
+            (279, 4, count, strip_byte_counts),
+            (284, 3, 1, 1),
+        ]
+        self.f.write(struct.pack('<H', len(entries)))
+        for tag, type_id, value_count, value in entries:
+            if type_id == 3 and value_count == 1:
+                self.f.write(struct.pack('<HHLHH', tag, type_id, value_count, value, 0))
+            else:
+                self.f.write(struct.pack('<HHLL', tag, type_id, value_count, value))
+        self.f.write(struct.pack('<L', 0))
+        self.f.seek(4)
+        self.f.write(struct.pack('<L', ifd_offset))
+
+def render_bands(poster, layout, outputs, band_height, encoder_options=None):
+    # Only one band of pixels is ever held in memory, so the peak is proportional to
+    # the band height rather than to the poster, whatever its size. outputs is a list
+    # of (file name or file object, format) pairs, all written from the same bands.
+    options = encoder_options or EncoderOptions()
+    for output, output_format in outputs:
+        if output_format not in ('png', 'tiff'):
+            raise ValueError(f'Banded rendering writes PNG or TIFF files, not {output_format}')
+    files = []
+    try:
+        writers = []
+        for output, output_format in outputs:
+            f = open(output, 'wb') if isinstance(output, str) else output
+            if f is not output:
+                files.append(f)
+            if output_format == 'png':
+                writers.append(PNGStripWriter(f, poster.width, poster.height,
+                                              6 if options.compress_level is None else options.compress_level,
+                                              PNG_STRATEGIES[options.png_strategy or 'default']))
+            else:
+                writers.append(TIFFStripWriter(f, poster.width, poster.height, band_height))
+        for top in range(0, poster.height, band_height):
+            start = phase_start()
+            band = draw_region(poster, layout, top, min(band_height, poster.height - top))
+            start = phase_end('draw', start, {'top': top})
+            for writer in writers:
+                writer.write(band)
+            phase_end('encode', start, {'top': top})
+        for writer in writers:
+            writer.close()
+    finally:
+        for f in files:
+            f.close()
+
+
+def get_font_names(lines):
+    return [line[len('!font '):] for line in map(str.strip, lines) if line.startswith('!font ')]
+
+def resolve_missing_fonts(font_map, lines):
+    # Resolves the fonts in lines that font_map doesn't know yet, in a single pass
+    # over the font index. Names that can't be resolved map to themselves.
+    missing = {name for name in get_font_names(lines) if name not in font_map and not is_font_file_spec(name)}
+    if missing:
+        resolved = resolve_font_names(missing)
+        for name in missing:
+            font_map[name] = resolved.get(name, name)
+
+def parse_size(size_str):
+    width, height = map(int, size_str.split('x'))
+    return width, height
+
+def parse_margin(margin_str):
+    if margin_str.endswith('%'):
+        return float(margin_str[:-1]) / 100
+    return int(margin_str)
+
+def set_font(poster, value, font_map):
+    poster.font = font_map.get(value, value)
+
+def set_size(poster, value, font_map):
+    poster.width, poster.height = parse_size(value)
+
+def set_margin(poster, value, font_map):
+    poster.margin = parse_margin(value)
+
+def set_background_color(poster, value, font_map):
+    poster.background_color = value
+
+def set_background_image(poster, value, font_map):
+    poster.background_image = value
+
+DIRECTIVES = {
+    'font': set_font,
+    'size': set_size,
+    'margin': set_margin,
+    'background_color': set_background_color,
+    'background_image': set_background_image,
+}
+
+def open_input(input_file):
+    # '-' reads standard input, which is left open afterwards
+    if input_file == '-':
+        return contextlib.nullcontext(sys.stdin)
+    return open(input_file, 'r')
+
+def load_poster(input_file, date_format, font_map=None, size=None, margin=None):
+    start = phase_start()
+    with open_input(input_file) as f:
+        lines = f.readlines()
+    poster = parse_poster(lines, date_format, font_map, size, margin)
+    phase_end('parse', start)
+    return poster
+
+def parse_poster(lines, date_format, font_map=None, size=None, margin=None):
+    # size and margin, when given, override the !size and !margin directives
+    poster = Poster()
+    lines = [line.strip() for line in lines]
+    
+    while lines and not lines[-1]:
+        lines.pop()
+
+    if font_map is None:
+        start = phase_start()
+        font_map = resolve_font_names(get_font_names(lines))
+        phase_end('fonts.resolve', start)
+    
+    for line in lines:
+        if line.startswith('!'):
+            command, _, value = line[1:].partition(' ')
+            directive = DIRECTIVES.get(command)
+            if directive is not None:
+                directive(poster, value, font_map)
+            continue
+
+        element = parse_line(line, poster, date_format)
+        if element:
+            poster.elements.append(element)
+
+    if size:
+        poster.width, poster.height = size
+    if margin is not None:
+        poster.margin = margin
+    return poster
+
+def iter_pages(lines, delimiter):
+    # Splits a stream of lines into the lines of each poster, reading only one poster
+    # at a time, so a generated feed of any length runs in constant memory.
+    # Pages with nothing on them, such as after a final delimiter, are skipped.
+    page = []
+    for line in lines:
+        line = line.strip()
+        if line == delimiter:
+            if any(page):
+                yield page
+            page = []
+        else:
+            page.append(line)
+    if any(page):
+        yield page
+
+def parse_page(lines, date_format, font_map, size=None, margin=None):
+    # Fonts are resolved as new names turn up and kept in font_map for the next pages
+    start = phase_start()
+    resolve_missing_fonts(font_map, lines)
+    poster = parse_poster(lines, date_format, font_map, size, margin)
+    phase_end('parse', start)
+    return poster
+
+
+def expand_batch_inputs(patterns):
+    input_files = []
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            # A manifest lists one input file or glob per line
+            with open(pattern[1:], 'r') as f:
+                entries = [line.strip() for line in f]
+            input_files.extend(expand_batch_inputs([entry for entry in entries if entry and not entry.startswith('#')]))
+        elif any(c in pattern for c in '*?['):
+            input_files.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            input_files.append(pattern)
+    return input_files
+
+def batch_output_name(template, input_file):
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    # Unknown placeholders are left as they are, as with --data and --page-delimiter
+    return merge_fields(template, {'stem': stem, 'dir': os.path.dirname(input_file) or '.'})
+
+def scan_batch_directives(input_files, size_override=None):
+    # A cheap pass over the directives only, so fonts are resolved once for the whole
+    # batch and backgrounds shared by several posters can be decoded ahead of time
+    font_names = set()
+    backgrounds = collections.Counter()
+    for input_file in input_files:
+        try:
+            with open(input_file, 'r') as f:
+                # Stripped first, as parse_poster() does, so indented directives count too
+                lines = [line for line in map(str.strip, f) if line.startswith('!')]
+        except OSError:
+            continue
+        font_names.update(get_font_names(lines))
+        size = (Poster().width, Poster().height)
+        background = None
+        for line in lines:
+            parts = line[1:].split(' ', 1)
+            try:
+                if parts[0] == 'size':
+                    size = parse_size(parts[1])
+                elif parts[0] == 'background_image':
+                    background = parts[1]
+            except (IndexError, ValueError):
+                pass
+        if background:
+            backgrounds[(background, size_override or size)] += 1
+    shared_backgrounds = [key for key, count in backgrounds.items() if count > 1]
+    return resolve_font_names(font_names), shared_backgrounds
+
+class RenderCache:
+    # Finished output files stored under a hash of everything that goes into them:
+    # the parsed poster, the fonts and images it uses, the output format and encoder
+    # settings, and this script itself. Entries are never updated in place, since a
+    # change to any input changes the key, so the cache only has to be kept in size.
+    def __init__(self, directory, max_bytes=RENDER_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def poster_key(self, poster, band_height=None, encoder_options=None):
+        elements = [[type(element).__name__, sorted(element_fields(element).items())] for element in poster.elements]
+        fonts = {}
+        for font_spec in {poster.font} | {element.font for element in poster.elements if isinstance(element, TextLine)}:
+            font_path, font_index = split_font_spec(font_spec)
+            try:
+                st = os.stat(font_path)
+                fonts[font_spec] = [os.path.abspath(font_path), font_index, st.st_size, st.st_mtime_ns]
+            except OSError:
+                fonts[font_spec] = None
+        images = {}
+        for path in poster_files(poster):
+            try:
+                images[path] = file_digest(path)
+            except OSError:
+                images[path] = None
+        # {date} is already filled in by the parser, so the date is part of the text
+        document = {
+            'script': file_digest(os.path.abspath(__file__)),
+            'pillow': Image.__version__,
+            'poster': [poster.width, poster.height, poster.margin, poster.background_color, poster.background_image, elements],
+            'fonts': sorted(fonts.items()),
+            'images': sorted(images.items()),
+            'band_height': band_height,
+            'encoder': list(encoder_options or EncoderOptions()),
+        }
+        return hashlib.sha256(json.dumps(document, default=repr).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key, output_format):
+        return os.path.join(self.directory, key[:2], f'{key}.{output_format}')
+
+    def fetch(self, key, output_format, output_file):
+        entry = self.entry_path(key, output_format)
+        try:
+            shutil.copyfile(entry, output_file)
+            # The modification time of an entry is when it was last used
+            os.utime(entry)
+        except FileNotFoundError:
+            if os.path.exists(entry):
+                raise
+            return False
+        return True
+
+    def store(self, key, output_format, output_file):
+        entry = self.entry_path(key, output_format)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # Written under a temporary name first, so other processes never see half a file
+        temporary = f'{entry}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.copyfile(output_file, temporary)
+        os.replace(temporary, entry)
+
+    def entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+        return entries
+
+    def evict(self):
+        # Removes the least recently used entries until the cache fits in max_bytes
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        return evicted, len(entries) - evicted, total
+
+    def report(self, hits, misses):
+        evicted, files, total = self.evict()
+        return (f'Render cache: {hits} hit(s), {misses} miss(es), {evicted} evicted, '
+                f'{files} file(s) using {total / 2 ** 20:.1f} of {self.max_bytes / 2 ** 20:.0f} MB')
+
+def render_poster_cached(poster, outputs, cache, band_height=None, encoder_options=None, encoder=None):
+    # Output files already in the cache are copied from it and the rest are rendered,
+    # then stored once they are written. Returns the encode futures, as render_poster()
+    # does, and whether every output came from the cache.
+    if cache is None:
+        return render_poster(poster, outputs, band_height=band_height, encoder_options=encoder_options, encoder=encoder), False
+    key = cache.poster_key(poster, band_height, encoder_options)
+    missing = [output for output in outputs if not cache.fetch(key, get_output_format(output), output)]
+    if not missing:
+        return [], True
+    futures = render_poster(poster, missing, band_height=band_height, encoder_options=encoder_options, encoder=encoder)
+    encoded = dict(zip([output for output in missing if get_output_format(output) not in ('pdf', 'svg')], futures))
+
+    def store_when_encoded(output):
+        def done(future):
+            if future.exception() is None:
+                cache.store(key, get_output_format(output), output)
+        return done
+
+    for output in missing:
+        if output in encoded:
+            encoded[output].add_done_callback(store_when_encoded(output))
+        else:
+            cache.store(key, get_output_format(output), output)
+    return futures, False
+
+worker_font_map = None
+worker_encoder_options = None
+worker_encoder = None
+worker_render_cache = None
+worker_band_height = None
+
+def init_batch_worker(font_map, backgrounds, encoder_options=None, encode_threads=0, render_cache=None, band_height=None):
+    global worker_font_map, worker_encoder_options, worker_encoder, worker_render_cache, worker_band_height
+    worker_font_map = font_map
+    worker_band_height = band_height
+    worker_encoder_options = encoder_options
+    worker_render_cache = render_cache
+    worker_encoder = concurrent.futures.ThreadPoolExecutor(encode_threads) if encode_threads else None
+    for path, size in backgrounds:
+        try:
+            load_background(path, size)
+        except OSError:
+            pass
+
+def encode_error(futures):
+    error = None
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            error = error or f'{type(e).__name__}: {e}'
+    return error
+
+def finished_renders(pending, max_pending):
+    # pending holds (name, outputs, start time, encode futures, cached) for posters that
+    # have been drawn. Yields them oldest first as their encoding finishes, and waits
+    # for the oldest once more than max_pending are still encoding.
+    while pending and (len(pending) > max_pending or all(future.done() for future in pending[0][3])):
+        name, outputs, start, futures, cached = pending.popleft()
+        yield name, outputs, encode_error(futures), time.perf_counter() - start, cached
+
+def render_batch_item(task):
+    input_file, output_files, date_format, size, margin = task
+    start = time.perf_counter()
+    try:
+        poster = load_poster(input_file, date_format, worker_font_map, size, margin)
+        futures, cached = render_poster_cached(poster, output_files, worker_render_cache, band_height=worker_band_height, encoder_options=worker_encoder_options, encoder=worker_encoder)
+        error = encode_error(futures)
+    except Exception as e:
+        error, cached = f'{type(e).__name__}: {e}', False
+    return input_file, output_files, error, time.perf_counter() - start, cached
+
+def render_batch_pipelined(tasks, max_pending):
+    # In a single process, the next poster is laid out and drawn while the encoder
+    # threads are still compressing the previous ones
+    pending = collections.deque()
+    for input_file, output_files, date_format, size, margin in tasks:
+        start = time.perf_counter()
+        try:
+            poster = load_poster(input_file, date_format, worker_font_map, size, margin)
+            futures, cached = render_poster_cached(poster, output_files, worker_render_cache, band_height=worker_band_height, encoder_options=worker_encoder_options, encoder=worker_encoder)
+        except Exception as e:
+            yield input_file, output_files, f'{type(e).__name__}: {e}', time.perf_counter() - start, False
+            continue
+        pending.append((input_file, output_files, start, futures, cached))
+        yield from finished_renders(pending, max_pending)
+    yield from finished_renders(pending, 0)
+
+def render_batch(input_files, output_templates, date_format, jobs=None, encoder_options=None, encode_threads=0, size=None, margin=None, render_cache=None, band_height=None):
+    jobs = jobs or os.cpu_count() or 1
+    tasks = [(input_file, [batch_output_name(template, input_file) for template in output_templates], date_format, size, margin) for input_file in input_files]
+    font_map, backgrounds = scan_batch_directives(input_files, size)
+
+    if jobs == 1 or len(tasks) == 1:
+        init_batch_worker(font_map, backgrounds, encoder_options, encode_threads, render_cache, band_height)
+        results = render_batch_pipelined(tasks, encode_threads)
+        pool = None
+    else:
+        # Each worker waits for its own encodes; the other workers keep the CPUs busy meanwhile
+        pool = multiprocessing.Pool(min(jobs, len(tasks)), initializer=init_batch_worker, initargs=(font_map, backgrounds, encoder_options, encode_threads, render_cache, band_height))
+        results = pool.imap_unordered(render_batch_item, tasks)
+
+    failures = []
+    cached_count = 0
+    try:
+        for done, (input_file, output_files, error, elapsed, cached) in enumerate(results, 1):
+            if error:
+                failures.append((input_file, error))
+                print(f'[{done}/{len(tasks)}] FAILED {input_file}: {error}', flush=True)
+            else:
+                cached_count += cached
+                print(f"[{done}/{len(tasks)}] {input_file} -> {', '.join(output_files)} ({'cached' if cached else f'{elapsed:.2f}s'})", flush=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        elif worker_encoder is not None:
+            worker_encoder.shutdown()
+
+    print(f'Rendered {len(tasks) - len(failures)} of {len(tasks)} posters, {len(failures)} failed.')
+    if render_cache is not None:
+        print(render_cache.report(cached_count, len(tasks) - cached_count))
+    return failures
+
+
+FIELD_PATTERN = re.compile(r'\{(\w+)\}')
+
+def merge_fields(text, fields):
+    def replace(match):
+        if match.group(1) not in fields:
+            return match.group(0)
+        value = fields[match.group(1)]
+        return '' if value is None else str(value)
+    return FIELD_PATTERN.sub(replace, text)
+
+UNSAFE_NAME_CHARACTERS = re.compile(r'[\x00-\x1f\x7f/\\]')
+
+def file_name_fields(fields):
+    # Field values put into output file names can only name a file, never a path:
+    # separators and control characters become '_', and so does a value that is
+    # only dots, which could otherwise climb out of the output directory
+    safe = {}
+    for name, value in fields.items():
+        value = UNSAFE_NAME_CHARACTERS.sub('_', '' if value is None else str(value))
+        safe[name] = '_' * len(value) if value and not value.strip('.') else value
+    return safe
+
+def iter_data_rows(data_file):
+    # Rows are read one at a time so a feed of any length runs in constant memory.
+    # They are decoded by data_row_fields(), so that a bad row only fails itself.
+    with open(data_file, 'r', newline='') as f:
+        if data_file.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield line
+        else:
+            reader = csv.DictReader(f)
+            while True:
+                try:
+                    yield next(reader)
+                except StopIteration:
+                    return
+                except csv.Error as e:
+                    yield e
+
+def data_row_fields(row_number, row):
+    if isinstance(row, csv.Error):
+        raise row
+    if isinstance(row, str):
+        row = json.loads(row)
+        if not isinstance(row, dict):
+            raise ValueError(f'Row {row_number} is a JSON {type(row).__name__}, not an object')
+    return {'row': row_number, **row}
+
+def merge_poster(template, fields):
+    poster = copy.copy(template)
+    poster.background_color = merge_fields(template.background_color, fields)
+    if template.background_image:
+        poster.background_image = merge_fields(template.background_image, fields)
+    poster.elements = []
+    for element in template.elements:
+        # Elements without placeholders are shared by every row
+        if isinstance(element, TextLine) and FIELD_PATTERN.search(element.text):
+            element = copy.copy(element)
+            element.text = merge_fields(element.text, fields)
+        elif isinstance(element, ImageElement) and FIELD_PATTERN.search(element.path):
+            element = copy.copy(element)
+            element.path = merge_fields(element.path, fields)
+        poster.elements.append(element)
+    return poster
+
+def render_each(items, encoder_options=None, encode_threads=0, render_cache=None, band_height=None):
+    # items yields (number, output files, a function that makes the poster) for one
+    # poster at a time, or the exception that kept it from being made in place of
+    # the function. Each poster is made and drawn while earlier ones are encoding.
+    encoder = concurrent.futures.ThreadPoolExecutor(encode_threads) if encode_threads else None
+    pending = collections.deque()
+    rendered = 0
+    failures = 0
+    cached_count = 0
+
+    def report(results):
+        nonlocal rendered, failures, cached_count
+        for number, output_files, error, _, cached in results:
+            if error:
+                failures += 1
+                print(f"[{number}] FAILED {', '.join(output_files)}: {error}", flush=True)
+            else:
+                rendered += 1
+                cached_count += cached
+                print(f"[{number}] {', '.join(output_files)}{' (cached)' if cached else ''}", flush=True)
+
+    for number, output_files, make_poster in items:
+        start = time.perf_counter()
+        try:
+            if isinstance(make_poster, Exception):
+                raise make_poster
+            futures, cached = render_poster_cached(make_poster(), output_files, render_cache, band_height=band_height, encoder_options=encoder_options, encoder=encoder)
+        except Exception as e:
+            report([(number, output_files, f'{type(e).__name__}: {e}', 0, False)])
+            continue
+        pending.append((number, output_files, start, futures, cached))
+        report(finished_renders(pending, encode_threads))
+    report(finished_renders(pending, 0))
+    if encoder is not None:
+        encoder.shutdown()
+    print(f'Rendered {rendered} of {rendered + failures} posters, {failures} failed.')
+    if render_cache is not None:
+        print(render_cache.report(cached_count, rendered + failures - cached_count))
+    return failures
+
+def render_merge(template_file, data_file, output_templates, date_format, encoder_options=None, encode_threads=0, size=None, margin=None, render_cache=None, band_height=None):
+    # The template is parsed and its fonts resolved once. Fonts, image sizes and text
+    # measurements are cached, so each row only pays for the lines it actually changes.
+    template = load_poster(template_file, date_format, size=size, margin=margin)
+
+    def items():
+        for row_number, row in enumerate(iter_data_rows(data_file), 1):
+            try:
+                fields = data_row_fields(row_number, row)
+            except (ValueError, csv.Error) as e:
+                # Reported as a failed row, named as far as the row number allows
+                output_files = [merge_fields(output_template, {'row': row_number}) for output_template in output_templates]
+                yield row_number, output_files, e
+                continue
+            output_files = [merge_fields(output_template, file_name_fields(fields)) for output_template in output_templates]
+            yield row_number, output_files, functools.partial(merge_poster, template, fields)
+
+    return render_each(items(), encoder_options, encode_threads, render_cache, band_height)
+
+def render_pages(input_file, delimiter, output_templates, date_format, encoder_options=None, encode_threads=0, size=None, margin=None, render_cache=None, band_height=None):
+    # One poster per page of the input, which may be standard input. Pages are parsed
+    # as they are read, and fonts resolved once for the whole stream.
+    font_map = {}
+    with open_input(input_file) as f:
+        def items():
+            for page_number, lines in enumerate(iter_pages(f, delimiter), 1):
+                output_files = [merge_fields(output_template, {'page': page_number}) for output_template in output_templates]
+                yield page_number, output_files, functools.partial(parse_page, lines, date_format, font_map, size, margin)
+
+        return render_each(items(), encoder_options, encode_threads, render_cache, band_height)
+
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+def poster_files(poster):
+    paths = [element.path for element in poster.elements if isinstance(element, ImageElement)]
+    if poster.background_image:
+        paths.append(poster.background_image)
+    return paths
+
+def placement_key(placement):
+    # Everything that affects how a placement is drawn. Elements are compared by
+    # value, and images by their modification time as well.
+    element = placement.element
+    mtime = file_mtime(element.path) if isinstance(element, ImageElement) else None
+    return repr(element), mtime, tuple(placement[1:])
+
+def dirty_rows(previous_layout, previous_keys, layout, keys):
+    # The row ranges that need redrawing, or None if elements have moved and
+    # the whole poster has to be drawn again
+    positions = [(type(p.element), p.y, p.height) for p in layout.placements]
+    previous_positions = [(type(p.element), p.y, p.height) for p in previous_layout.placements]
+    if positions != previous_positions:
+        return None
+    rows = []
+    for old, new, old_key, new_key in zip(previous_layout.placements, layout.placements, previous_keys, keys):
+        if old_key != new_key:
+            for first_row, last_row in (placement_rows(old), placement_rows(new)):
+                rows.append((max(int(first_row), 0), min(math.ceil(last_row), layout.height)))
+    merged = []
+    for top, bottom in sorted(rows):
+        if merged and top <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], bottom))
+        elif bottom > top:
+            merged.append((top, bottom))
+    return merged
+
+def watch_poster(input_file, output_file, date_format, preview=False, band_height=None, encoder_options=None, size=None, margin=None):
+    # Fonts, images and text measurements stay cached between edits, and so do the
+    # previous layout and canvas. When an edit leaves every element where it was,
+    # only the rows of the elements that changed are drawn again.
+    font_map = {}
+    watched = {}
+    previous = None
+    output_format = get_output_format(output_file)
+    raster = output_format not in ('pdf', 'svg') and not band_height
+    encoder_options = encoder_options or EncoderOptions()
+    redraw_options = encoder_options
+    if redraw_options.compress_level is None:
+        # Previews favour a quick save over a small file
+        redraw_options = redraw_options._replace(compress_level=0)
+    print(f'Watching {input_file} for changes. Press Ctrl-C to stop.', flush=True)
+    try:
+        while True:
+            if watched and all(file_mtime(path) == mtime for path, mtime in watched.items()):
+                time.sleep(WATCH_INTERVAL)
+                continue
+
+            start = time.perf_counter()
+            try:
+                with open(input_file, 'r') as f:
+                    lines = f.readlines()
+                resolve_missing_fonts(font_map, lines)
+                poster = parse_poster(lines, date_format, font_map, size, margin)
+                watched = {path: file_mtime(path) for path in [input_file] + poster_files(poster)}
+
+                if not raster:
+                    render_poster(poster, output_file, band_height=band_height, encoder_options=encoder_options)
+                    summary = 'full render'
+                else:
+                    layout = layout_poster(poster)
+                    keys = [placement_key(placement) for placement in layout.placements]
+                    settings = (poster.width, poster.height, poster.background_color, poster.background_image, file_mtime(poster.background_image))
+                    regions = None
+                    if previous and previous[0] == settings:
+                        regions = dirty_rows(previous[1], previous[2], layout, keys)
+                    if regions is None:
+                        image = draw_region(poster, layout, 0, poster.height)
+                        summary = 'full redraw'
+                    else:
+                        image = previous[3]
+                        for top, bottom in regions:
+                            image.paste(draw_region(poster, layout, top, bottom - top), (0, top))
+                        summary = f'redrew {len(regions)} region(s)'
+                    previous = (settings, layout, keys, image)
+                    if regions == []:
+                        summary = 'no visible changes'
+                    else:
+                        save_image(image, output_file, output_format, redraw_options)
+            except Exception as e:
+                # Keep going with whatever was there before, and wait for the next edit
+                watched = {path: file_mtime(path) for path in set(watched) | {input_file}}
+                print(f'Error: {type(e).__name__}: {e}', flush=True)
+                continue
+
+            print(f'{output_file}: {summary} in {(time.perf_counter() - start) * 1000:.0f} ms', flush=True)
+            if preview:
+                open_preview(output_file)
+                preview = False
+    except KeyboardInterrupt:
+        pass
+
+def open_preview(output_file):
+    if os.name == 'posix':
+        subprocess.run(['xdg-open', output_file])
+    elif os.name == 'mac':
+        subprocess.run(['open', output_file])
+    elif os.name == 'nt':
+        os.startfile(output_file)
+
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'tiff': 'image/tiff',
+    'pdf': 'application/pdf',
+    'svg': 'image/svg+xml',
+}
+
+def init_render_worker(font_map, preload_fonts=()):
+    # Each worker keeps its resolved fonts and its font, text and asset caches for
+    # its whole life. It starts with every installed font already resolved, and the
+    # preloaded fonts opened at the size text is measured at, so that the first
+    # request doesn't pay for the font index or for opening the usual fonts.
+    global worker_font_map
+    worker_font_map = font_map
+    for font_spec in preload_fonts:
+        get_font(font_spec, REFERENCE_FONT_SIZE)
+
+def render_request(task):
+    text, options = task
+    start = time.perf_counter()
+    try:
+        lines = text.splitlines()
+        resolve_missing_fonts(worker_font_map, lines)
+        size = parse_size(options['size']) if options.get('size') else None
+        margin = parse_margin(options['margin']) if options.get('margin') else None
+        poster = parse_poster(lines, options['date_format'], worker_font_map, size, margin)
+        buffer = io.BytesIO()
+        render_poster(poster, buffer, output_format=options['format'], encoder_options=options['encoder'])
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}', time.perf_counter() - start
+    return buffer.getvalue(), None, time.perf_counter() - start
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f'p{p}': round(values[max(0, math.ceil(p / 100 * len(values)) - 1)] * 1000, 2) for p in (50, 90, 99)}
+
+class RenderService:
+    def __init__(self, jobs, queue_size, date_format, encoder_options=None, preload_fonts=()):
+        self.jobs = jobs
+        self.queue_size = queue_size
+        self.date_format = date_format
+        self.encoder_options = encoder_options
+        font_map = get_font_map()
+        preload_specs = []
+        for name in preload_fonts:
+            if name in font_map or is_font_file_spec(name):
+                preload_specs.append(font_map.get(name, name))
+            else:
+                print(f'Warning: Font {name} not found, so it is not preloaded.', flush=True)
+        self.pool = multiprocessing.Pool(jobs, initializer=init_render_worker, initargs=(font_map, preload_specs))
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.render_times = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def render(self, text, options):
+        # Requests beyond the queue size are turned away at once rather than
+        # piling up behind a busy pool
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return None
+        start = time.perf_counter()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            data, error, render_time = self.pool.apply(render_request, ((text, options),))
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.in_flight -= 1
+        with self.lock:
+            self.requests += 1
+            if error:
+                self.failed += 1
+            else:
+                self.latencies.append(time.perf_counter() - start)
+                self.render_times.append(render_time)
+        return data, error
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.jobs,
+                'queue_size': self.queue_size,
+                'in_flight': self.in_flight,
+                'queue_depth': max(0, self.in_flight - self.jobs),
+                'requests': self.requests,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'latency_ms': percentiles(self.latencies),
+                'render_ms': percentiles(self.render_times),
+            }
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    def send_body(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_text(self, status, message, headers=()):
+        self.send_body(status, 'text/plain; charset=utf-8', (message + '\n').encode('utf-8'), headers)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/stats':
+            self.send_body(200, 'application/json', json.dumps(self.server.service.stats(), indent=2).encode('utf-8'))
+        elif path == '/health':
+            self.send_body(200, 'text/plain; charset=utf-8', b'ok\n')
+        else:
+            self.send_error_text(404, f'Not found: {path}')
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/render':
+            self.send_error_text(404, f'Not found: {url.path}')
+            return
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        output_format = OUTPUT_FORMATS.get('.' + query.get('format', 'png').lower())
+        if output_format is None:
+            self.send_error_text(400, f"Unknown format: {query['format']}")
+            return
+        size = query.get('size')
+        if size and not re.fullmatch(r'\d+x\d+', size):
+            self.send_error_text(400, f'Size must be <width>x<height>, not {size}')
+            return
+        try:
+            text = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        except (ValueError, UnicodeDecodeError):
+            self.send_error_text(400, 'The request body must be a UTF-8 input file.')
+            return
+
+        service = self.server.service
+        options = {
+            'format': output_format,
+            'size': size,
+            'margin': query.get('margin'),
+            'date_format': query.get('date_format', service.date_format),
+            'encoder': service.encoder_options,
+        }
+        result = service.render(text, options)
+        if result is None:
+            self.send_error_text(503, 'The render queue is full, try again shortly.', [('Retry-After', '1')])
+            return
+        data, error = result
+        if error:
+            self.send_error_text(400, error)
+        else:
+            self.send_body(200, CONTENT_TYPES[output_format], data)
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def serve_posters(address, jobs, queue_size, date_format, encoder_options=None, preload_fonts=()):
+    host, port = parse_address(address)
+    jobs = jobs or os.cpu_count() or 1
+    # Bind before starting the workers, so an address in use fails straight away
+    try:
+        server = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    except OSError as e:
+        raise ValueError(f'cannot listen on {host}:{port}: {e.strerror or e}')
+    try:
+        service = RenderService(jobs, queue_size or jobs * 4, date_format, encoder_options, preload_fonts)
+    except BaseException:
+        server.server_close()
+        raise
+    server.daemon_threads = True
+    server.service = service
+    print(f'Serving posters on http://{host}:{server.server_port}/ with {jobs} workers and a queue of {service.queue_size}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def write_profile(profile_file):
+    finished = stop_profile()
+    with open(profile_file, 'w') as f:
+        json.dump(finished.trace(), f)
+    print(finished.summary(), file=sys.stderr)
 
-    image.save(output_filename)
 
 def main():
     parser = argparse.ArgumentParser(description='Create posters from a text file.')
-    parser.add_argument('input_file', nargs='?', help='The input file for the poster.')
-    parser.add_argument('-o', '--output', help='The output file name.', default='output.png')
-    parser.add_argument('--size', help='The size of the output image in the format <width>x<height>.')
+    parser.add_argument('input_file', nargs='*', help='The input file for the poster, or - to read standard input. With --batch, any number of input files, globs or @manifest files.')
+    parser.add_argument('-o', '--output', action='append', help='The output file name. Can be given more than once to write several files, such as a PNG and a JPEG, from one render. With --batch, a template where {stem} and {dir} are the name and directory of each input file.')
+    parser.add_argument('--size', action='append', help='The size of the output image in the format <width>x<height>. Can be given more than once to write the poster at several sizes.')
+    parser.add_argument('--resample', choices=['auto', 'layout', 'pyramid'], default='auto', help='How the smaller sizes are made when several are given: laid out again, resampled from the largest, or whichever is faster. The default is auto.')
     parser.add_argument('--list-common-fonts', action='store_true', help='List common fonts and exit.')
     parser.add_argument('--list-fonts', action='store_true', help='List all available fonts and exit.')
     parser.add_argument('--preview', action='store_true', help='Preview the generated image.')
     parser.add_argument('--margin', help='The margin for the poster as a percentage or in pixels.')
     parser.add_argument('--date-format', help='The format for the date string, if used.', default='%m/%d/%Y')
+    parser.add_argument('--rebuild-font-cache', action='store_true', help='Rescan all fonts and rebuild the font cache.')
+    parser.add_argument('--batch', action='store_true', help='Render every input file, reporting each success or failure without stopping.')
+    parser.add_argument('--data', help='A CSV or JSONL file. The input file is used as a template and one poster is rendered per row.')
+    parser.add_argument('--page-delimiter', metavar='LINE', help='Treat the input as many posters, separated by lines that are exactly LINE, such as ---, and render one per page.')
+    parser.add_argument('--watch', action='store_true', help='Keep running and render the poster again whenever the input file or its images change.')
+    parser.add_argument('--layout-only', action='store_true', help='Print the computed layout as JSON instead of rendering the poster.')
+    parser.add_argument('--band-height', type=int, help='Render the poster in horizontal bands of this many rows, streaming them to a PNG or TIFF file to bound memory use.')
+    parser.add_argument('--profile', metavar='TRACE_FILE', help='Record the time spent in each phase and write it to this file as a Chrome trace, then print a summary.')
+    parser.add_argument('--serve', metavar='[HOST:]PORT', help='Run an HTTP render service on this address instead of rendering a file.')
+    parser.add_argument('--preload-font', action='append', metavar='FONT', help='With --serve, open this font in every worker at startup. Can be given more than once.')
+    parser.add_argument('--queue-size', type=int, help='The number of requests --serve accepts at once before answering 503. Defaults to four per worker.')
+    parser.add_argument('--compress-level', type=int, choices=range(10), metavar='0-9', help='The zlib compression level for PNG output. Lower is faster and bigger. The default is 6.')
+    parser.add_argument('--png-strategy', choices=sorted(PNG_STRATEGIES), help='The zlib compression strategy for PNG output.')
+    parser.add_argument('--quality', type=int, help='The quality, from 1 to 100, for JPEG and WebP output, and for TIFF output with JPEG compression.')
+    parser.add_argument('--subsampling', choices=['4:4:4', '4:2:2', '4:2:0'], help='The chroma subsampling for JPEG output.')
+    parser.add_argument('--tiff-compression', choices=['raw', 'tiff_deflate', 'tiff_lzw', 'tiff_adobe_deflate', 'jpeg', 'packbits'], help='The compression for TIFF output.')
+    parser.add_argument('--cache-dir', help='Keep finished posters in this directory and copy them from it instead of rendering again when nothing that goes into them has changed.')
+    parser.add_argument('--cache-size', type=int, default=RENDER_CACHE_BYTES // 2 ** 20, help='The largest size of the --cache-dir directory in megabytes. The least recently used posters are removed beyond it. The default is 1024.')
+    parser.add_argument('--encode-threads', type=int, default=0, help='Encode output files on this many background threads, so the next poster is drawn while the previous one is compressed.')
+    parser.add_argument('--draw-threads', type=int, default=0, help='Decode images and rasterize text on this many threads, then composite them in order. Helps most with large posters that have many images.')
+    parser.add_argument('-j', '--jobs', type=int, help='The number of worker processes for --batch and --serve. Defaults to the number of CPUs.')
     args = parser.parse_args()
+    encoder_options = EncoderOptions(args.compress_level, args.png_strategy, args.quality, args.subsampling, args.tiff_compression)
+    try:
+        sizes = [parse_size(size) for size in args.size or []]
+        margin = parse_margin(args.margin) if args.margin else None
+    except ValueError as e:
+        parser.error(f'invalid --size or --margin: {e}')
+    size = sizes[0] if len(sizes) == 1 else None
+    if args.band_height is not None:
+        if args.band_height <= 0:
+            parser.error('--band-height must be a positive number of rows')
+        # PDF and SVG outputs are written as vectors and never banded
+        formats = {get_output_format(output) for output in args.output or []} - {'pdf', 'svg'}
+        if formats - {'png', 'tiff'}:
+            parser.error('--band-height can only write .png and .tif/.tiff files')
+    render_cache = RenderCache(args.cache_dir, args.cache_size * 2 ** 20) if args.cache_dir else None
+
+    if args.rebuild_font_cache:
+        get_font_map(rebuild=True)
+        if not (args.input_file or args.list_fonts or args.list_common_fonts):
+            return
 
     if args.list_common_fonts:
         list_fonts(common_only=True)
@@ -499,56 +2538,82 @@ def main():
         list_fonts()
         return
 
+    if args.profile and (args.serve or args.batch or args.watch):
+        parser.error('--profile cannot be used with --serve, --batch or --watch')
+
+    if args.serve:
+        try:
+            serve_posters(args.serve, args.jobs, args.queue_size, args.date_format, encoder_options, args.preload_font or [])
+        except ValueError as e:
+            parser.error(f'--serve: {e}')
+        return
+
     if not args.input_file:
         parser.error('the following arguments are required: input_file')
 
-    font_map = get_font_map()
-    poster = Poster()
+    if len(sizes) > 1 and (args.batch or args.data or args.page_delimiter or args.watch or args.layout_only):
+        parser.error('several --size values can only be used to render a single poster')
 
-    with open(args.input_file, 'r') as f:
-        lines = f.readlines()
-    
-    while lines and not lines[-1].strip():
-        lines.pop()
-    
-    for line in lines:
-        line = line.strip()
-        if line.startswith('!'):
-            parts = line[1:].split(' ', 1)
-            command = parts[0]
-            if command == 'font':
-                font_name = parts[1]
-                if font_name in font_map:
-                    poster.font = font_map[font_name]
-                else:
-                    poster.font = font_name
-            elif command == 'size':
-                poster.width, poster.height = map(int, parts[1].split('x'))
-            elif command == 'margin':
-                margin_str = parts[1]
-                if margin_str.endswith('%'):
-                    poster.margin = float(margin_str[:-1]) / 100
-                else:
-                    poster.margin = int(margin_str)
-            elif command == 'background_color':
-                poster.background_color = parts[1]
-            elif command == 'background_image':
-                poster.background_image = parts[1]
-            continue
+    if args.layout_only and (args.batch or args.data or args.watch):
+        parser.error('--layout-only cannot be used with --batch, --data or --watch')
 
-        element = parse_line(line, poster, args.date_format)
-        if element:
-            poster.elements.append(element)
+    if args.profile:
+        start_profile()
+    start_draw_threads(args.draw_threads)
+
+    if args.batch:
+        input_files = expand_batch_inputs(args.input_file)
+        failures = render_batch(input_files, args.output or [os.path.join('{dir}', '{stem}.png')], args.date_format, args.jobs, encoder_options, args.encode_threads, size, margin, render_cache, args.band_height)
+        sys.exit(1 if failures else 0)
+
+    if len(args.input_file) > 1:
+        parser.error('only one input_file may be given without --batch')
+    input_file = args.input_file[0]
+
+    if args.page_delimiter:
+        if args.data or args.watch or args.layout_only:
+            parser.error('--page-delimiter cannot be used with --data, --watch or --layout-only')
+        failures = render_pages(input_file, args.page_delimiter, args.output or ['poster_{page}.png'], args.date_format, encoder_options, args.encode_threads, size, margin, render_cache, args.band_height)
+        if args.profile:
+            write_profile(args.profile)
+        sys.exit(1 if failures else 0)
 
-    render_poster(poster, args.output)
+    if args.data:
+        failures = render_merge(input_file, args.data, args.output or ['poster_{row}.png'], args.date_format, encoder_options, args.encode_threads, size, margin, render_cache, args.band_height)
+        if args.profile:
+            write_profile(args.profile)
+        sys.exit(1 if failures else 0)
+
+    outputs = args.output or ['output.png']
+
+    if args.watch:
+        if input_file == '-':
+            parser.error('--watch needs an input file rather than standard input')
+        if len(outputs) > 1:
+            parser.error('only one output file may be given with --watch')
+        watch_poster(input_file, outputs[0], args.date_format, preview=args.preview, band_height=args.band_height, encoder_options=encoder_options, size=size, margin=margin)
+        return
+
+    poster = load_poster(input_file, args.date_format, size=size, margin=margin)
+    if args.layout_only:
+        print(json.dumps(layout_to_json(layout_poster(poster)), indent=2))
+    else:
+        encoder = concurrent.futures.ThreadPoolExecutor(args.encode_threads) if args.encode_threads else None
+        if len(sizes) > 1:
+            targets = [(target, [sized_output_name(output, target) for output in outputs]) for target in sizes]
+            futures = render_sizes(poster, targets, args.resample, encoder_options, encoder, args.band_height)
+            outputs = targets[0][1]
+        else:
+            futures, cached = render_poster_cached(poster, outputs, render_cache, band_height=args.band_height, encoder_options=encoder_options, encoder=encoder)
+        for future in futures:
+            future.result()
+        if render_cache is not None and len(sizes) <= 1:
+            print(render_cache.report(int(cached), int(not cached)))
+    if args.profile:
+        write_profile(args.profile)
 
-    if args.preview:
-        if os.name == 'posix':
-            subprocess.run(['xdg-open', args.output])
-        elif os.name == 'mac':
-            subprocess.run(['open', args.output])
-        elif os.name == 'nt':
-            os.startfile(args.output)
+    if args.preview and not args.layout_only:
+        open_preview(outputs[0])
 
 
 if __name__ == '__main__':